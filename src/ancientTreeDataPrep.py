@@ -4,6 +4,10 @@ import numpy as np
 import pathlib
 import os
 import json
+import datetime as dt
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
 
 #Load in configs and dependencies
 baseDir=pathlib.Path(__file__).parent.resolve()
@@ -16,78 +20,486 @@ datafolder=os.path.join(parentDir,configs["inputfolder"])
 outputfolder=os.path.join(parentDir,configs["outputfolder"])
 outputfolderDummy=os.path.join(parentDir,configs["outputfolderDummy"])
 sourcefile = os.path.join(datafolder,configs["ati_inputfile"])
+markerDict = configs["markerDict"]
+# plain text replacements within marker values e.g. mis-encoded apostrophes and dashes
+markerReplacements = configs["markerReplacements"]
+# column types of the download, fixed rather than inferred so that every chunk is typed as per the whole file (any column not listed is read as text)
+sourceTypes = collections.defaultdict(lambda: 'str', configs["sourceTypes"])
+typedOutput = configs["outputFormat"]=='partitioned'
+coordinateFields = ['Latitude', 'Longitude', 'x', 'y']
+partitionFields = ['Country', 'RegionID']
+# aggregate tables are small, so kept as single files (parquet alongside the typed output)
+aggregateFormat = 'parquet' if typedOutput else 'csv'
+# null fills, type casts, value maps and groupings, compiled once (the partitioned output is typed, so keeps coordinates as numbers)
+cleaningRules = configs["cleaningRules"]
+if typedOutput:
+    cleaningRules = {**cleaningRules, **{each:{'steps':[{'cast':'float64'}]} for each in coordinateFields}}
+compiledRules = functions.compileRules(cleaningRules)
+# settings which derived values depend on - incremental runs reprocess every record when these (or the region polygons) change
+derivedSettings = ['sourceTypes', 'markerDict', 'markerReplacements', 'regionMaxDistance', 'geocodeTowns', 'categoryFields', 'dateFields', 'addDatetimes', 'speciesGroups']
 
 
-# load raw ATI base data (downloaded from https://opendata-woodlandtrust.hub.arcgis.com/datasets)
-sourceData=pd.read_csv(sourcefile)
+def readSource(**kwargs):
+    """Read the ATI download (downloaded from https://opendata-woodlandtrust.hub.arcgis.com/datasets) with the column types in sourceTypes
 
-#Get vis polygon geometries
-regionpolygons=functions.fetchPolygons( files= {'uki_regionfile': os.path.join(datafolder,configs["uki_regionfile"]), \
-                                          'guernsey_regionfile':os.path.join(datafolder,configs["guernsey_regionfile"]), \
-                                          'iom_regionfile':os.path.join(datafolder,configs["iom_regionfile"]) }, \
-                              outputfolder= os.path.join(datafolder,configs["all_regionfolder"]))
+    Args:
+        **kwargs: passed to read_csv e.g. usecols, chunksize
 
-# assign geographic regions based on polygons and x/y
-sourceData=functions.assignPolygon(sourceData, regionpolygons)
+    Returns:
+        DataFrame: raw ATI records (or an iterator of chunks of them, if chunksize is given)
+    """
+    return pd.read_csv(sourcefile, dtype=sourceTypes, **kwargs)
 
 
-# create boolean flags for fields with markers
-markerDict = configs["markerDict"]
-functions.createBoolFlag(sourceData, markerDict)
+def prepBatch(sourceData, regionpolygons, updateLookup=True, keepPosition=False):
+    """Run every transformation stage over a batch of raw ATI records (either the full download, or one chunk / partition of it)
+
+    Args:
+        sourceData (DataFrame): raw ATI records, as loaded from the download csv
+        regionpolygons (GeoDataFrame): region polygons from fetchPolygons
+        updateLookup (bool, optional): write newly seen species spellings back to the species lookup file. Defaults to True.
+        keepPosition (bool, optional): keep the position of each marker within its tree's list in the Marker table, for merging batches (see createMarkerTable). Defaults to False.
+
+    Returns:
+        DataFrame, DataFrame, dict: Base table and Marker table for the given records, and the species spellings newly grouped (see assignSpeciesGroups)
+    """
+    # assign geographic regions based on polygons and x/y
+    # trees outside every polygon take the nearest one, within an optional search distance (metres, null for no limit)
+    # (Town is only kept where it has been enriched by reverse geocoding)
+    sourceData=functions.assignPolygon(sourceData, regionpolygons, configs["regionMaxDistance"], ['Town'] if configs["geocodeTowns"] else [])
+
+
+    # create boolean flags for fields with markers
+    functions.createBoolFlag(sourceData, markerDict)
+
+    # Null handling ('Unknown'), data types, species 'other' as 'Unknown' and the higher level grouping for Public Accessibility - see cleaningRules in the config
+    functions.applyRules(sourceData, compiledRules)
+
+    if not typedOutput:
+        #convert Lat/Long to 8dp (11,8) and store as string (for python only)
+        sourceData.Latitude=sourceData.Latitude.str.ljust(11, '0')
+        sourceData.Longitude=sourceData.Longitude.str.ljust(11, '0')
+        #convert X/Y to 11dp (16,11) and store as string (for python only)
+        sourceData.x=sourceData.x.str.ljust(17, '0')
+        sourceData.y=sourceData.y.str.ljust(17, '0')
+
+    # Date fields appear to be in mm/dd/yyyy format. No indication that it is inconsistent, therefore we will treat these uniformly
+    # Set null value as 31/12/9999
+    functions.fixDates(sourceData, configs["dateFields"], addDatetimes=configs["addDatetimes"])
+
+
+    # Apply grouping to create new higher-level species column. This list generated during EDA - see relevant notebook
+    species_groups=configs["speciesGroups"]
+    # each distinct spelling is grouped once, and remembered between runs in the species lookup file
+    newGroups=functions.assignSpeciesGroups(sourceData, species_groups, os.path.join(datafolder,configs["speciesLookupFile"]), updateLookup)
+
+    # Create high level flags for Alive status and Ash Dieback
+    #(whilst AOD/COD (acute/chronic oak decline) appears in the LivingStatus column, the counts are much lower and not split between confirmed/suspected. This field therefore not possible to scale as yet)
+    functions.livingStatusFlags(sourceData)
+
+    # create marker table with one row per marker per tree (can have multi markers of the same type e.g Fungus)
+    markerTable=functions.createMarkerTable(sourceData, markerDict, markerReplacements, keepPosition)
+
+    sourceData=sourceData.drop(columns=markerDict)
+
+    if typedOutput:
+        # low-cardinality text fields stored as categoricals (dictionary-encoded in parquet)
+        functions.compactTypes(sourceData, configs["categoryFields"])
+        functions.compactTypes(markerTable, configs["categoryFields"])
+    return sourceData, markerTable, newGroups
+
+
+def initWorker(polygons, profileFolder=None):
+    """Process pool initialiser - hold one copy of the region polygons per worker, rather than sending them with every partition
+
+    Args:
+        polygons (GeoDataFrame): region polygons from fetchPolygons
+        profileFolder (str, optional): folder for per-stage cProfile dumps, as per the parent process. Defaults to None.
+    """
+    global workerPolygons
+    workerPolygons=polygons
+    functions.profileFolder=profileFolder
+
+
+def prepPartition(sourceData):
+    """Process pool task - run prepBatch over one partition using the worker's copy of the region polygons. 
+    The species lookup file is only updated by the parent process (with the spellings each worker newly grouped), so that workers don't write to it concurrently
+
+    Args:
+        sourceData (DataFrame): partition of raw ATI records
+
+    Returns:
+        DataFrame, DataFrame, list, dict: Base table and Marker table (with MarkerPosition, for combineBatches) for the partition, the worker's stage timings, 
+            and the species spellings newly grouped
+    """
+    functions.stageReport.clear()
+    baseData, markerTable, newGroups=prepBatch(sourceData, workerPolygons, updateLookup=False, keepPosition=True)
+    return baseData, markerTable, list(functions.stageReport), newGroups
+
+
+def enrichTowns(sourceData):
+    """Fill missing Town values by reverse geocoding, using the backend and cache set up in the config (see geocoder)
+
+    Args:
+        sourceData (DataFrame): raw ATI records
+
+    Returns:
+        DataFrame: raw ATI records with Town populated where possible
+    """
+    geocoder=configs["geocoder"]
+    backend=functions.geocodeBackends[geocoder["backend"]](**geocoder["backendOptions"])
+    return functions.enrichTowns(sourceData, backend, os.path.join(datafolder,geocoder["cacheFile"]), geocoder["precision"], 
+                                 batchSize=geocoder["batchSize"], requestsPerSecond=geocoder["requestsPerSecond"], 
+                                 concurrency=geocoder["concurrency"], retries=geocoder["retries"])
+
+
+def runBatch(sourceData, regionpolygons, pool=None, keepPosition=False):
+    """Run all stages over the given records - either directly, or split by row across the process pool and merged back in original order
+
+    Args:
+        sourceData (DataFrame): raw ATI records
+        regionpolygons (GeoDataFrame): region polygons from fetchPolygons
+        pool (ProcessPoolExecutor, optional): worker pool, initialised with initWorker. Defaults to None (run in this process).
+        keepPosition (bool, optional): keep the MarkerPosition column in the Marker table (see createMarkerTable). Defaults to False.
+
+    Returns:
+        DataFrame, DataFrame: Base table and Marker table for the given records
+    """
+    # Town enrichment runs here rather than in prepBatch, so that the rate limit and cache file are shared by every partition
+    if configs["geocodeTowns"]:
+        sourceData=enrichTowns(sourceData)
+
+    if pool is None:
+        return prepBatch(sourceData, regionpolygons, keepPosition=keepPosition)[:2]
+
+    results=list(pool.map(prepPartition, functions.splitBatches(sourceData, configs["workers"])))
+    for each in results:
+        functions.stageReport.extend(each[2])
+    baseData, markerTable=functions.combineBatches([each[0] for each in results], [each[1] for each in results], markerDict, keepPosition=keepPosition)
+    # persist any new species spellings from the workers
+    functions.updateSpeciesLookup(os.path.join(datafolder,configs["speciesLookupFile"]), configs["speciesGroups"], {spelling: group for each in results for spelling, group in each[3].items()})
+    return baseData, markerTable
+
+
+def settingsFingerprint(regionpolygons):
+    """Fingerprint of the cleaning rules, derivedSettings and region polygons, saved with the manifest so incremental runs can tell whether previous outputs are stale
+
+    Args:
+        regionpolygons (GeoDataFrame): region polygons from fetchPolygons
+
+    Returns:
+        str: hex digest
+    """
+    return functions.fingerprintSettings({'cleaningRules': cleaningRules, **{each: configs[each] for each in derivedSettings}}, regionpolygons)
+
+
+def runIncremental(sourceData, manifest, regionpolygons, fingerprint, pool=None):
+    """Incremental mode - compare the download against the manifest of the previous run, reprocess only new or changed records, 
+    and merge these into the previous Base and Marker tables (dropping any deleted records). Falls back to a full refresh if no previous run is available, 
+    if the settings or region polygons have changed since it, or if either download repeats an Id (as records can't be matched by Id).
+
+    Args:
+        sourceData (DataFrame): raw ATI records
+        manifest (DataFrame): change manifest of sourceData (see hashRows)
+        regionpolygons (GeoDataFrame): region polygons from fetchPolygons
+        fingerprint (str): fingerprint of the current settings and region polygons (see settingsFingerprint)
+        pool (ProcessPoolExecutor, optional): worker pool, initialised with initWorker. Defaults to None (run in this process).
+
+    Returns:
+        DataFrame, DataFrame, tuple: Base table and Marker table for all records, and the tree/marker counts updated from the previous run's 
+            (None if aggregates are off or weren't available from the previous run)
+    """
+    previousFiles=[functions.findLatestFile(outputfolder, 'ATI_manifest'), 
+                   functions.findLatestFile(outputfolder, 'ATI_Base_table', configs["outputFormat"]), 
+                   functions.findLatestFile(outputfolder, 'ATI_Marker_table', configs["outputFormat"])]
+    if None in previousFiles:
+        print('No previous run available - running full refresh')
+        return (*runBatch(sourceData, regionpolygons, pool), None)
+    previousFingerprint=functions.findLatestFile(outputfolder, 'ATI_settings_fingerprint')
+    if previousFingerprint is None or functions.loadFile(previousFingerprint).Fingerprint[0]!=fingerprint:
+        print('Settings or region polygons changed since the previous run - running full refresh')
+        return (*runBatch(sourceData, regionpolygons, pool), None)
+    previousManifest=functions.loadFile(previousFiles[0])
+    if not (manifest.Id.is_unique and previousManifest.Id.is_unique):
+        print('Repeated Ids in the download or the previous run - running full refresh')
+        return (*runBatch(sourceData, regionpolygons, pool), None)
+
+    changed, deleted=functions.compareManifests(manifest, previousManifest)
+    previousBase=functions.loadFile(previousFiles[1], configs["outputFormat"])
+    previousMarkers=functions.loadFile(previousFiles[2], configs["outputFormat"])
+    baseTables=[previousBase[~previousBase.Id.isin(changed|deleted)]]
+    markerTables=[previousMarkers[~previousMarkers.Id.isin(changed|deleted)]]
+    if len(changed)>0:
+        newBase, newMarkers=runBatch(sourceData[sourceData.Id.astype(str).isin(changed)], regionpolygons, pool)
+        baseTables.append(newBase)
+        markerTables.append(newMarkers)
+
+    # update the previous run's counts - removing the changed/deleted records as previously processed, and adding the reprocessed records
+    counts=None
+    previousCounts=[functions.findLatestFile(outputfolder, 'ATI_Tree_counts', aggregateFormat), functions.findLatestFile(outputfolder, 'ATI_Marker_counts', aggregateFormat)]
+    if configs["aggregates"] and None not in previousCounts:
+        removed=buildAggregates(previousBase[previousBase.Id.isin(changed|deleted)], previousMarkers[previousMarkers.Id.isin(changed|deleted)])
+        added=[buildAggregates(newBase, newMarkers)] if len(changed)>0 else []
+        counts=tuple(functions.combineAggregates([functions.loadFile(previousCounts[i], aggregateFormat)]+[each[i] for each in added], fields, [removed[i]])
+                     for i, fields in enumerate([configs["treeCountFields"], configs["markerCountFields"]]))
+
+    # merge back into the order of the download, as per a full refresh
+    idOrder=pd.Series(np.arange(len(manifest)), index=manifest.Id)
+    return (*functions.combineBatches(baseTables, markerTables, markerDict, idOrder), counts)
+
+
+def buildAggregates(baseData, markerTable):
+    """Count trees and markers for dashboard use, by the fields set in the config (see treeCountFields and markerCountFields)
+
+    Args:
+        baseData (DataFrame): Base table
+        markerTable (DataFrame): Marker table
+
+    Returns:
+        DataFrame, DataFrame: tree counts and marker counts
+    """
+    return functions.aggregateTrees(baseData, configs["treeCountFields"]), functions.aggregateMarkers(baseData, markerTable, configs["markerCountFields"])
+
+
+def saveTables(baseData, markerTable, prefix, folder, timestamp=None, append=False):
+    """Save the Base and Marker tables in the configured output format. For partitioned outputs, markers take the Country/RegionID of their tree so both tables share the same partitions
+
+    Args:
+        baseData (DataFrame): Base table
+        markerTable (DataFrame): Marker table
+        prefix (string): file name prefix e.g. DUMMY_ (or empty)
+        folder (string): output folder location
+        timestamp (string, optional): timestamp suffix, see saveFile. Defaults to None.
+        append (bool, optional): append to existing outputs, see saveFile. Defaults to False.
+    """
+    if typedOutput:
+        treeLookup=baseData.drop_duplicates('Id').set_index('Id')
+        markerTable=markerTable.assign(**{each: markerTable.Id.map(treeLookup[each]) for each in partitionFields})
+    functions.saveFile(baseData, f'{prefix}ATI_Base_table' , folder, configs["outputFormat"], timestamp, append, partitionFields)
+    functions.saveFile(markerTable, f'{prefix}ATI_Marker_table' , folder, configs["outputFormat"], timestamp, append, partitionFields)
+
+
+def saveAggregates(treeCounts, markerCounts, prefix, folder, timestamp=None):
+    """Save the tree and marker counts (see buildAggregates)
+
+    Args:
+        treeCounts (DataFrame): tree counts
+        markerCounts (DataFrame): marker counts
+        prefix (string): file name prefix e.g. DUMMY_ (or empty)
+        folder (string): output folder location
+        timestamp (string, optional): timestamp suffix, see saveFile. Defaults to None.
+    """
+    if typedOutput:
+        functions.compactTypes(treeCounts, configs["treeCountFields"])
+        functions.compactTypes(markerCounts, configs["markerCountFields"])
+    functions.saveFile(treeCounts, f'{prefix}ATI_Tree_counts' , folder, aggregateFormat, timestamp)
+    functions.saveFile(markerCounts, f'{prefix}ATI_Marker_counts' , folder, aggregateFormat, timestamp)
+
+
+def loadPolygons():
+    """Get the vis region polygon geometries - from the cache if up to date, otherwise rebuilt from the shape files (see fetchPolygons)
+
+    Returns:
+        GeoDataFrame: region polygons
+    """
+    return functions.fetchPolygons( files= {'uki_regionfile': os.path.join(datafolder,configs["uki_regionfile"]), \
+                                      'guernsey_regionfile':os.path.join(datafolder,configs["guernsey_regionfile"]), \
+                                      'iom_regionfile':os.path.join(datafolder,configs["iom_regionfile"]) }, \
+                          outputfolder= os.path.join(datafolder,configs["all_regionfolder"]))
+
+
+def saveCheckpoints(baseData, markerTable, append=False):
+    """Checkpoint the finished Base and Marker tables (Arrow IPC, in the checkpoints sub-folder of the outputs) for the markers, counts and dummy stages 
+    and any other jobs to memory-map, see writeCheckpoint
+
+    Args:
+        baseData (DataFrame): Base table
+        markerTable (DataFrame): Marker table
+        append (bool, optional): add to the existing checkpoints e.g. for each chunk. Defaults to False.
+    """
+    functions.writeCheckpoint(baseData, 'ATI_Base_table', os.path.join(outputfolder, 'checkpoints'), append)
+    functions.writeCheckpoint(markerTable, 'ATI_Marker_table', os.path.join(outputfolder, 'checkpoints'), append)
+
+
+def loadCheckpoint(filename, columns=None):
+    """Memory-map a checkpoint saved by the prep stage, see readCheckpoint
+
+    Args:
+        filename (string): checkpoint name e.g. ATI_Base_table
+        columns (list, optional): only load these columns. Defaults to None (all columns).
+
+    Returns:
+        DataFrame: checkpointed table
+    """
+    data=functions.readCheckpoint(filename, os.path.join(outputfolder, 'checkpoints'), columns)
+    if data is None:
+        raise SystemExit(f'No {filename} checkpoint found in {outputfolder} - run the prep stage first')
+    return data
+
+
+def saveDummy(sourceData, markerTable):
+    """Create dummy datasets for Github storage (in place of ATI data) from samples of the Base and Marker tables, replacing any previous dummy outputs
+
+    Args:
+        sourceData (DataFrame): Base table
+        markerTable (DataFrame): Marker table
+    """
+    baseDummy, otherDummy=functions.createDummyFiles(sourceData, [markerTable], indexField='OBJECTID', makeUnknownFields=['RecorderOrganisationName'])
+    markerDummy=otherDummy[0]
+    saveTables(baseDummy, markerDummy, 'DUMMY_', outputfolderDummy)
+    if configs["aggregates"]:
+        saveAggregates(*buildAggregates(baseDummy, markerDummy), 'DUMMY_', outputfolderDummy)
+
+
+def runPolygons():
+    """polygons stage - build (or refresh) the cached region polygons"""
+    regionpolygons=loadPolygons()
+    print(f'{len(regionpolygons)} region polygons available')
+
+
+def runPrep():
+    """prep stage - run the full pipeline over the download: Base, Marker and count tables, manifest and dummy datasets"""
+    # every stage is timed for the run report - optionally also profile each stage with cProfile
+    if configs["profileStages"]:
+        functions.profileFolder=os.path.join(outputfolder, 'profiles')
+
+    #Get vis polygon geometries
+    regionpolygons=loadPolygons()
+    fingerprint=settingsFingerprint(regionpolygons)
+
+    # optionally spread the per-record stages across several processes (see workers in config)
+    pool=None
+    if configs["workers"]>1:
+        pool=ProcessPoolExecutor(max_workers=configs["workers"], initializer=initWorker, initargs=(regionpolygons, functions.profileFolder))
+
+    # load raw ATI base data
+    if configs["chunkSize"] is None:
+        sourceData=readSource()
+        manifest=functions.hashRows(sourceData)
+        counts=None
+        if configs["incremental"]:
+            sourceData, markerTable, counts=runIncremental(sourceData, manifest, regionpolygons, fingerprint, pool)
+        else:
+            sourceData, markerTable=runBatch(sourceData, regionpolygons, pool)
+        # counts for the dashboards, unless already updated from the previous run
+        if configs["aggregates"] and counts is None:
+            counts=buildAggregates(sourceData, markerTable)
+
+        #archive existing files
+        functions.archiveFiles(outputfolder)
+        functions.archiveFiles(outputfolderDummy)
+
+        #save Base and Marker Tables
+        saveTables(sourceData, markerTable, '', outputfolder)
+        saveCheckpoints(sourceData, markerTable)
+        #save change manifest and settings fingerprint, for use in the next incremental run
+        functions.saveFile(manifest, 'ATI_manifest' , outputfolder)
+        functions.saveFile(pd.DataFrame({'Fingerprint': [fingerprint]}), 'ATI_settings_fingerprint', outputfolder)
+        if configs["aggregates"]:
+            saveAggregates(*counts, '', outputfolder)
+
+    else:
+        # chunked mode - stream the download through every stage in fixed-size batches, appending each batch to the outputs so only one batch is held in memory at a time
+        # (incremental runs are not supported in chunked mode, but the manifest is still saved for the next whole-file run)
+        functions.archiveFiles(outputfolder)
+        functions.archiveFiles(outputfolderDummy)
+        now=dt.datetime.now().strftime("%d-%m-%Y_%H%M")
+        counts=None
+        # Ids repeated anywhere in the download - their duplicate markers are dropped across chunks, as per a whole-file run (see makePivot)
+        sourceIds=readSource(usecols=['Id']).Id
+        repeatedIds=set(sourceIds[sourceIds.duplicated()])
+        keptMarkers=set()
+        for i, chunk in enumerate(readSource(chunksize=configs["chunkSize"])):
+            print(f'Processing chunk {i} ({len(chunk)} records)')
+            # hashed before the stages change the chunk - as the column types are fixed, this matches the manifest from a whole-file run
+            functions.saveFile(functions.hashRows(chunk), 'ATI_manifest' , outputfolder, timestamp=now, append=True)
+            chunkBase, chunkMarkers=runBatch(chunk, regionpolygons, pool, keepPosition=len(repeatedIds)>0)
+            if len(repeatedIds)>0:
+                chunkMarkers=functions.dropRepeatedMarkers(chunkMarkers, repeatedIds, keptMarkers)
+            saveTables(chunkBase, chunkMarkers, '', outputfolder, timestamp=now, append=True)
+            saveCheckpoints(chunkBase, chunkMarkers, append=i>0)
+            # running totals of the counts, as each chunk covers separate trees
+            if configs["aggregates"]:
+                chunkCounts=buildAggregates(chunkBase, chunkMarkers)
+                counts=chunkCounts if counts is None else tuple(functions.combineAggregates([counts[j], chunkCounts[j]], fields) 
+                                                      for j, fields in enumerate([configs["treeCountFields"], configs["markerCountFields"]]))
+        functions.saveFile(pd.DataFrame({'Fingerprint': [fingerprint]}), 'ATI_settings_fingerprint', outputfolder, timestamp=now)
+        if configs["aggregates"]:
+            saveAggregates(*counts, '', outputfolder, timestamp=now)
+        # dummy datasets are sampled from every chunk, via the checkpoints
+        sourceData, markerTable=loadCheckpoint('ATI_Base_table'), loadCheckpoint('ATI_Marker_table')
+
+    if pool is not None:
+        pool.shutdown()
+
+    #create dummy datasets for Github storage (in place of ATI data)
+    saveDummy(sourceData, markerTable)
+
 
-# Null handling for specific fields - Unknown
-fillNAFields=configs["fillNAFields"]
-functions.fillnans(sourceData, fillNAFields)
+def runMarkers():
+    """markers stage - rebuild only the Marker table (and marker counts) from the download, without the geospatial stages. 
+    Regions are taken from the Base table checkpoint, so the prep stage must have been run before"""
+    # only the Id and marker fields of the download are needed
+    sourceData=readSource(usecols=['Id', *markerDict])
+    functions.applyRules(sourceData, compiledRules)
+    markerTable=functions.createMarkerTable(sourceData, markerDict, markerReplacements)
 
+    treeFields=[*(partitionFields if typedOutput else []), *(configs["markerCountFields"] if configs["aggregates"] else [])]
+    treeFields=[each for each in dict.fromkeys(treeFields) if each not in markerTable.columns]
+    baseData=loadCheckpoint('ATI_Base_table', ['Id', *treeFields]) if len(treeFields)>0 else None
+    # typed as per the prep stage (see prepBatch), so the checkpoint matches one written by a full run
+    if typedOutput:
+        functions.compactTypes(markerTable, configs["categoryFields"])
+    functions.writeCheckpoint(markerTable, 'ATI_Marker_table', os.path.join(outputfolder, 'checkpoints'))
+    if typedOutput:
+        treeLookup=baseData.drop_duplicates('Id').set_index('Id')
+        markerTable=markerTable.assign(**{each: markerTable.Id.map(treeLookup[each]) for each in partitionFields})
 
-# enforce data types
-typeDict=configs["typeDict"]
-functions.typeCheck(sourceData, typeDict)
+    functions.archiveFiles(outputfolder, 'ATI_Marker_')
+    functions.saveFile(markerTable, 'ATI_Marker_table' , outputfolder, configs["outputFormat"], partitionCols=partitionFields)
+    if configs["aggregates"]:
+        markerCounts=functions.aggregateMarkers(baseData, markerTable, configs["markerCountFields"])
+        if typedOutput:
+            functions.compactTypes(markerCounts, configs["markerCountFields"])
+        functions.saveFile(markerCounts, 'ATI_Marker_counts' , outputfolder, aggregateFormat)
 
-#convert Lat/Long to 8dp (11,8) and store as string (for python only)
-sourceData.Latitude=sourceData.Latitude.str.ljust(11, '0')
-sourceData.Longitude=sourceData.Longitude.str.ljust(11, '0')
-#convert X/Y to 11dp (16,11) and store as string (for python only)
-sourceData.x=sourceData.x.str.ljust(17, '0')
-sourceData.y=sourceData.y.str.ljust(17, '0')
 
-# Date fields appear to be in mm/dd/yyyy format. No indication that it is inconsistent, therefore we will treat these uniformly
-# Set null value as 31/12/9999
-functions.fixDates(sourceData, configs["dateFields"])
+def runCounts():
+    """counts stage - recount the tree and marker count tables from the Base and Marker table checkpoints"""
+    counts=buildAggregates(loadCheckpoint('ATI_Base_table'), loadCheckpoint('ATI_Marker_table'))
+    functions.archiveFiles(outputfolder, 'ATI_Tree_counts')
+    functions.archiveFiles(outputfolder, 'ATI_Marker_counts')
+    saveAggregates(*counts, '', outputfolder)
 
 
-# Apply grouping to create new higher-level species column. This list generated during EDA - see relevant notebook
-species_groups=configs["speciesGroups"]
-sourceData['Species']=np.where(sourceData['Species'].str.lower()=='other', 'Unknown',sourceData['Species'] )
-sourceData['SpeciesGroup']=sourceData.Species.apply(lambda x:functions.groupSpecies(x, species_groups) )
-print('Species grouping complete')
+def runDummy():
+    """dummy stage - recreate the dummy datasets from the Base and Marker table checkpoints"""
+    sourceData, markerTable=loadCheckpoint('ATI_Base_table'), loadCheckpoint('ATI_Marker_table')
+    functions.archiveFiles(outputfolderDummy)
+    saveDummy(sourceData, markerTable)
 
-# Create high level flags for Alive status and Ash Dieback
-#(whilst AOD/COD (acute/chronic oak decline) appears in the LivingStatus column, the counts are much lower and not split between confirmed/suspected. This field therefore not possible to scale as yet)
-sourceData=sourceData.apply(lambda x: functions.livingStatusFlags(x), axis=1)
-print('new LivingStatus columns complete')
 
-#create higher level grouping for Public Accessibility
-sourceData['PublicAccessibilityGroup']=sourceData.PublicAccessibilityStatus.apply(lambda x: x.split(' ')[0])
-sourceData.PublicAccessibilityGroup=np.where(sourceData.PublicAccessibilityGroup.isin(['Public', 'Private']), sourceData.PublicAccessibilityGroup, 'Unknown')
-print('Public accessibility groupings complete')
+stages={'polygons': runPolygons, 'prep': runPrep, 'markers': runMarkers, 'counts': runCounts, 'dummy': runDummy}
 
-# create marker table with one row per marker per tree (can have multi markers of the same type e.g Fungus)
-markerTable=functions.createMarkerTable(sourceData, markerDict)
 
-sourceData=sourceData.drop(columns=markerDict)
+def main(argv=None):
+    """Command line entry point - run one stage of the pipeline (default: prep, the full pipeline), and save the run report with timings per stage
+        python src/ancientTreeDataPrep.py [polygons|prep|markers|counts|dummy]
 
-#archive existing files
-functions.archiveFiles(outputfolder)
-functions.archiveFiles(outputfolderDummy)
+    Args:
+        argv (list, optional): command line arguments. Defaults to None (sys.argv).
+    """
+    parser=argparse.ArgumentParser(description='Ancient Tree Inventory data prep. Settings are read from src/config.json')
+    parser.add_argument('stage', nargs='?', default='prep', choices=stages, 
+                        help='polygons: build the cached region polygons. prep: full pipeline (default). '
+                             'markers: rebuild the Marker table from the download, using the regions of the checkpointed Base table. '
+                             'counts: recount the tree and marker count tables from the checkpointed Base and Marker tables. '
+                             'dummy: recreate the dummy datasets from the checkpointed Base and Marker tables')
+    args=parser.parse_args(argv)
+    stages[args.stage]()
+    functions.writeStageReport(outputfolder)
 
-#save Base Table
-functions.saveFile(sourceData, 'ATI_Base_table' , outputfolder, configs["outputFormat"])
-#save Marker Table
-functions.saveFile(markerTable, 'ATI_Marker_table' , outputfolder, configs["outputFormat"])
 
-#create dummy datasets for Github storage (in place of ATI data)
-baseDummy, otherDummy=functions.createDummyFiles(sourceData, [markerTable], indexField='OBJECTID', makeUnknownFields=['RecorderOrganisationName'])
-markerDummy=otherDummy[0]
-functions.saveFile(baseDummy, 'DUMMY_ATI_Base_table' , outputfolderDummy, configs["outputFormat"])
-functions.saveFile(markerDummy, 'DUMMY_ATI_Marker_table' , outputfolderDummy, configs["outputFormat"])
\ No newline at end of file
+# guard needed so that pool workers (which re-import this module on Windows) don't re-run the pipeline
+if __name__ == '__main__':
+    main()
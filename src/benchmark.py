@@ -0,0 +1,225 @@
+import ancientTreeDataPrep as prep
+import pandas as pd
+import numpy as np
+import shapely
+import pyproj
+import argparse
+import subprocess
+import tempfile
+import time
+import json
+import glob
+import os
+
+# Benchmark harness for the ATI data prep pipeline. Generates synthetic ATI-shaped downloads at a range of sizes (using only the region shapefiles in data/input, so runs offline),
+# runs the full pipeline over each and stores the per-stage timings against the current git commit, so that hot-path regressions can be compared between commits.
+#   python src/benchmark.py                      (10k, 100k, 1M and 10M rows)
+#   python src/benchmark.py --sizes 10000 100000
+
+benchfolder=os.path.join(prep.parentDir, 'data', 'input', 'benchmark')
+resultsfile=os.path.join(prep.parentDir, 'data', 'output', 'benchmarks', 'benchmark_results.csv')
+
+speciesFamilies=['oak', 'ash', 'beech', 'lime', 'sycamore', 'yew', 'sweet chestnut', 'horse chestnut', 'hawthorn', 'willow', 'alder', 'elm', 'pine',
+                 'cherry', 'field maple', 'walnut', 'cedar', 'birch', 'hornbeam', 'holly', 'hazel', 'rowan', 'crab apple', 'black poplar']
+speciesPrefixes=['', 'english ', 'sessile ', 'pedunculate ', 'common ', 'scots ', 'wild ', 'white ', 'hybrid ', 'crack ', 'small-leaved ', 'large-leaved ']
+livingStatuses=['Alive', 'Alive', 'Alive', 'Dead', 'Other - Chalara fraxinea (Ash dieback) suspected', 'Other - Chalara fraxinea (Ash dieback) confirmed',
+                'Other - Acute oak decline (AOD) suspected', 'Unknown']
+accessStatuses=['Public - restricted access', 'Public - open access', 'Private - no access information recorded', 'Private - not visible from public access',
+                'Public - Scottish Outdoor Access', 'Unknown']
+markerValues={'Protection': ['Tree Preservation Order', 'SSSI', 'Conservation area', 'Uncultivated land', 'National Trust', "Owner''s land"],
+              'Epiphyte': ['Lichen', 'Moss', 'Ivy', 'Fern', 'Mistletoe', 'Polypody'],
+              'Fungus': ['Beefsteak fungus', 'Chicken of the woods', 'Dryadâ€™s saddle', 'Oak bracket', 'Birch polypore', 'Honey fungus', 'Artistâ€™s fungus'],
+              'Condition': ['Hollowing', 'Deadwood in canopy', 'Bark loss', 'Fallen limbs', 'Rot holes', 'Water pockets', 'Sap runs'],
+              'SpecialStatus': ['Champion tree', 'Heritage tree', 'Tree of national special interest', 'Historic boundary marker'],
+              'Surroundings': ['Parkland', 'Hedgerow', 'Woodland â€“ broadleaf', 'Field', 'Garden', 'Churchyard', 'Roadside']}
+
+
+def samplePoints(polygons, n, rng, coastalShare=0.02):
+    """Generate x/y coordinates (EPSG:27700) spread over the region polygons, with a small share offset just outside them (e.g. coastal trees)
+
+    Args:
+        polygons (GeoDataFrame): region polygons from fetchPolygons
+        n (int): number of points
+        rng (Generator): numpy random generator
+        coastalShare (float, optional): share of points to be placed near, rather than within, a region. Defaults to 0.02.
+
+    Returns:
+        ndarray, ndarray: x and y coordinates
+    """
+    area=shapely.union_all(np.asarray(polygons.SimplifiedGeometry.values))
+    shapely.prepare(area)
+    minx, miny, maxx, maxy=area.bounds
+    xs, ys, found=[], [], 0
+    while found<n:
+        x=rng.uniform(minx, maxx, 1_000_000)
+        y=rng.uniform(miny, maxy, 1_000_000)
+        inside=shapely.contains_xy(area, x, y)
+        xs.append(x[inside])
+        ys.append(y[inside])
+        found+=inside.sum()
+    x=np.concatenate(xs)[:n]
+    y=np.concatenate(ys)[:n]
+    coastal=rng.random(n)<coastalShare
+    x[coastal]+=rng.normal(0, 3000, coastal.sum())
+    y[coastal]+=rng.normal(0, 3000, coastal.sum())
+    return x, y
+
+
+def markerColumn(values, n, rng, maxMarkers=6, nullShare=0.4):
+    """Generate a concatenated marker column, with between 1 and maxMarkers comma-separated values per tree (or null)
+
+    Args:
+        values (list): possible marker values
+        n (int): number of records
+        rng (Generator): numpy random generator
+        maxMarkers (int, optional): maximum markers listed per tree. Defaults to 6.
+        nullShare (float, optional): share of trees with no markers. Defaults to 0.4.
+
+    Returns:
+        ndarray: marker column (object)
+    """
+    values=np.array(values, dtype=object)
+    counts=rng.integers(1, maxMarkers+1, n)
+    column=values[rng.integers(0, len(values), n)]
+    for i in range(1, maxMarkers):
+        column=np.where(counts>i, column+','+values[rng.integers(0, len(values), n)], column)
+    column[rng.random(n)<nullShare]=np.nan
+    return column
+
+
+def makeSyntheticATI(n, polygons, seed=0):
+    """Generate a synthetic dataset in the format of the raw ATI download
+
+    Args:
+        n (int): number of records
+        polygons (GeoDataFrame): region polygons from fetchPolygons, used to place trees
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        DataFrame: synthetic ATI records
+    """
+    rng=np.random.default_rng(seed)
+    x, y=samplePoints(polygons, n, rng)
+    longitude, latitude=pyproj.Transformer.from_crs('EPSG:27700', 'EPSG:4326', always_xy=True).transform(x, y)
+
+    species=np.array([(prefix+family).capitalize() for prefix in speciesPrefixes for family in speciesFamilies]+['Other', 'other', 'Unknown tree'], dtype=object)
+    # a few very common spellings account for most trees
+    speciesWeights=1/np.arange(1, len(species)+1)
+    speciesCol=species[rng.choice(len(species), n, p=speciesWeights/speciesWeights.sum())]
+    speciesCol[rng.random(n)<0.01]=np.nan
+
+    # US format dates, as per the download
+    dates=np.array([f'{each.month}/{each.day}/{each.year} 12:00:00 AM' for each in pd.date_range('1990-01-01', periods=12000)], dtype=object)
+    surveyDate=dates[rng.integers(0, len(dates), n)]
+    surveyDate[rng.random(n)<0.05]=np.nan
+    verifiedDate=dates[rng.integers(0, len(dates), n)]
+
+    data=pd.DataFrame({'OBJECTID': np.arange(1, n+1), 'Id': rng.permutation(n)+100000, 'SurveyDate': surveyDate, 'VerifiedDate': verifiedDate,
+                       'MeasuredGirth': rng.gamma(4, 1.2, n).round(2), 'MeasuredHeight': rng.choice([0.5, 1.0, 1.3, 1.5], n), 'EstimatedGirth': rng.random(n)<0.3,
+                       'Latitude': latitude.round(8), 'Longitude': longitude.round(8), 'GridReference': 'SO4419566235', 'Species': speciesCol,
+                       'TreeForm': rng.choice(np.array(['Maiden', 'Pollard managed', 'Pollard unmanaged', 'Coppice', np.nan], dtype=object), n),
+                       'RecorderOrganisationName': rng.choice(np.array(['Woodland Trust', 'Tree Register', np.nan], dtype=object), n), 'LocalName': np.nan,
+                       'StandingStatus': rng.choice(np.array(['Standing', 'Fallen', np.nan], dtype=object), n, p=[0.9, 0.05, 0.05]),
+                       'LivingStatus': rng.choice(np.array(livingStatuses+[np.nan], dtype=object), n),
+                       'PublicAccessibilityStatus': rng.choice(np.array(accessStatuses+[np.nan], dtype=object), n),
+                       'VeteranStatus': rng.choice(['Ancient tree', 'Veteran tree', 'Notable tree'], n)})
+    for each in prep.markerDict:
+        data[each]=markerColumn(markerValues[each], n, rng)
+    data['x']=x
+    data['y']=y
+    data['Town']=np.nan
+    data['County']=np.nan
+    data['Country']=np.nan
+    return data
+
+
+def gitCommit():
+    """Get the current git commit, used to key benchmark results
+
+    Returns:
+        str: short commit hash, or 'unknown' if not available
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=prep.parentDir, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def runPipeline(sourcefile):
+    """Run the full data prep pipeline (the prep stage of ancientTreeDataPrep) over the given download, writing outputs to a temporary folder
+
+    Args:
+        sourcefile (str): location of the (synthetic) ATI download
+
+    Returns:
+        float, dict: end-to-end wall time (seconds), and the run report recorded by the pipeline
+    """
+    with tempfile.TemporaryDirectory() as tempfolder:
+        for each in ['actual', 'dummy']:
+            os.makedirs(os.path.join(tempfolder, each, 'archive'))
+        prep.sourcefile=sourcefile
+        prep.outputfolder=os.path.join(tempfolder, 'actual')
+        prep.outputfolderDummy=os.path.join(tempfolder, 'dummy')
+        # full refresh every time, with a fresh species lookup
+        prep.configs["incremental"]=False
+        prep.configs["speciesLookupFile"]=os.path.join(tempfolder, 'species_group_lookup.json')
+
+        start=time.perf_counter()
+        prep.main(['prep'])
+        wallTime=time.perf_counter()-start
+        with open(glob.glob(os.path.join(prep.outputfolder, 'ATI_run_report_*.json'))[0], 'r') as f:
+            report=json.load(f)
+    return wallTime, report
+
+
+def saveResults(results):
+    """Append benchmark results to the results file, and print a comparison against the latest results from a different commit
+
+    Args:
+        results (DataFrame): one record per size/stage, including commit and wallTime
+    """
+    if os.path.exists(resultsfile):
+        previous=pd.read_csv(resultsfile, dtype={'commit': str})
+        previous=previous[previous.commit!=results.commit.iloc[0]]
+        if len(previous)>0:
+            baseline=previous[previous.run==previous.run.max()]
+            comparison=results.merge(baseline[['rows', 'stage', 'wallTime']], on=['rows', 'stage'], how='left', suffixes=('', 'Baseline'))
+            comparison['change']=(comparison.wallTime/comparison.wallTimeBaseline-1).map(lambda x: '' if pd.isnull(x) else f'{x:+.0%}')
+            print(f'Comparison with commit {baseline.commit.iloc[0]}:')
+            print(comparison[['rows', 'stage', 'wallTimeBaseline', 'wallTime', 'change']].to_string(index=False))
+    else:
+        os.makedirs(os.path.dirname(resultsfile), exist_ok=True)
+    results.to_csv(resultsfile, index=False, mode='a', header=not os.path.exists(resultsfile))
+    print(f'Benchmark results saved to {resultsfile}')
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Benchmark the ATI data prep pipeline over synthetic downloads')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10_000, 100_000, 1_000_000, 10_000_000], help='number of synthetic records per run')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic data')
+    args=parser.parse_args()
+
+    polygons=prep.loadPolygons()
+    os.makedirs(benchfolder, exist_ok=True)
+    run=time.strftime('%Y-%m-%dT%H:%M:%S')
+    commit=gitCommit()
+
+    results=[]
+    for n in args.sizes:
+        # synthetic downloads are kept between runs, so every commit is benchmarked against the same data
+        sourcefile=os.path.join(benchfolder, f'ATI_synthetic_{n}_{args.seed}.csv')
+        if not os.path.exists(sourcefile):
+            print(f'Generating synthetic download with {n} records')
+            makeSyntheticATI(n, polygons, args.seed).to_csv(sourcefile, index=False)
+
+        wallTime, report=runPipeline(sourcefile)
+        # per stage, the peak memory sampled during the stage (the process high-water mark is only reported end to end)
+        stages=pd.DataFrame(report['stages']).groupby('stage', sort=False).agg(wallTime=('wallTime', 'sum'), peakRSS=('stagePeakRSS', 'max')).reset_index()
+        stages=pd.concat([stages, pd.DataFrame([{'stage': 'endToEnd', 'wallTime': wallTime, 'peakRSS': report['peakRSS']}])], ignore_index=True)
+        results.append(stages.assign(run=run, commit=commit, rows=n, workers=prep.configs["workers"], wallTime=stages.wallTime.round(4)))
+
+    saveResults(pd.concat(results, ignore_index=True)[['run', 'commit', 'rows', 'workers', 'stage', 'wallTime', 'peakRSS']])
+
+
+if __name__ == '__main__':
+    main()
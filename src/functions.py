@@ -1,33 +1,221 @@
 import pandas as pd
 import numpy as np
-import geopandas as gpd
 import os
 import datetime as dt
 import re 
+import json
+import glob
+import hashlib
+import psutil
+import time
+import functools
+import cProfile
+import sys
+import itertools
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# geopandas, shapely and pyarrow are slow to import, so are only imported by the stages which need them (fetchPolygons, assignPolygon and the checkpoints)
+
+
+# Stage instrumentation - every pipeline stage is wrapped with profileStage, which records one entry per call in stageReport. 
+# Set profileFolder to a folder location to also dump a cProfile file per stage call.
+stageReport=[]
+profileFolder=None
+
+
+def peakRSS():
+    """Get the peak resident memory (RSS) of this process so far
 
+    Returns:
+        int: peak RSS in bytes
+    """
+    memory=psutil.Process().memory_info()
+    if hasattr(memory, 'peak_wset'):
+        # Windows
+        return memory.peak_wset
+    import resource
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform=='darwin' else peak*1024
 
-def fillnans(data, fields):
-    """For each of the listed fields, replace nulls (in place) in the base dataset with 'Unknown'
+
+def sampleRSS(stop, samples, interval=0.01):
+    """Sample the resident memory (RSS) of this process until stop is set, keeping the highest sample in samples[0] - run in a thread alongside a stage
 
     Args:
-        data (DataFrame): Base data table within which nulls are to be replaced with 'Unknown'
-        fields (list): list of fields which need 'Unknown' as nulls
+        stop (threading.Event): set to stop sampling
+        samples (list): one element list holding the highest RSS seen so far
+        interval (float, optional): seconds between samples. Defaults to 0.01.
     """
-    for each in fields:
-        data[each]=data[each].fillna('Unknown')
-    print('Null handling complete')
-        
-        
-def typeCheck(data, types_dict):
-    """Ensure all base data columns align with target data types
+    process=psutil.Process()
+    while not stop.wait(interval):
+        samples[0]=max(samples[0], process.memory_info().rss)
+
+
+def profileStage(func):
+    """Decorator for pipeline stages - record wall time, memory and rows in/out of each call in stageReport. 
+    Rows in are taken from the first argument (if a DataFrame), rows out from the returned DataFrame (or the first argument, for in-place stages).
+    Memory is recorded as RSS at the start and end of the call, the peak RSS sampled during the call (stagePeakRSS), how far the call raised 
+    the process high-water mark (peakRSSIncrease - exact, but zero if an earlier stage peaked higher) and the process high-water mark itself (peakRSS)
 
     Args:
-        data (DatFrame): Base data which is to have data types set
-        types_dict (dictionary): lookup between column name and required data type
+        func (function): pipeline stage
+
+    Returns:
+        function: wrapped stage
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        data=args[0] if len(args)>0 and isinstance(args[0], pd.DataFrame) else None
+        rowsIn=len(data) if data is not None else None
+        rssStart=psutil.Process().memory_info().rss
+        peakStart=peakRSS()
+        stagePeak=[rssStart]
+        stop=threading.Event()
+        sampler=threading.Thread(target=sampleRSS, args=(stop, stagePeak), daemon=True)
+        profiler=cProfile.Profile() if profileFolder is not None else None
+        startTime=dt.datetime.now()
+        sampler.start()
+        start=time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result=func(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wallTime=time.perf_counter()-start
+            stop.set()
+            sampler.join()
+        rssEnd=psutil.Process().memory_info().rss
+        peakEnd=peakRSS()
+
+        output=result[0] if isinstance(result, tuple) else result
+        if isinstance(output, pd.DataFrame):
+            rowsOut=len(output)
+        else:
+            rowsOut=len(data) if data is not None else None
+        entry={'stage': func.__name__, 'pid': os.getpid(), 'start': startTime.isoformat(timespec='seconds'), 'wallTime': round(wallTime, 4), 
+               'rowsIn': rowsIn, 'rowsOut': rowsOut, 'rssStart': rssStart, 'rssEnd': rssEnd, 'stagePeakRSS': max(stagePeak[0], rssEnd), 
+               'peakRSSIncrease': peakEnd-peakStart, 'peakRSS': peakEnd}
+        if profiler is not None:
+            if not os.path.exists(profileFolder):
+                os.makedirs(profileFolder)
+            entry['profile']=os.path.join(profileFolder, f'{len(stageReport):03d}_{func.__name__}_{os.getpid()}.prof')
+            profiler.dump_stats(entry['profile'])
+        stageReport.append(entry)
+        return result
+    return wrapper
+
+
+def writeStageReport(folder, filename='ATI_run_report', timestamp=None):
+    """Save the recorded stage timings (see profileStage) as a json run report, with a timestamp suffix on filename, and reset the recorded stages
+
+    Args:
+        folder (string): output folder location
+        filename (string, optional): requested file name. Defaults to 'ATI_run_report'.
+        timestamp (string, optional): timestamp suffix to use in place of the current time. Defaults to None.
+    """
+    now=timestamp if timestamp is not None else dt.datetime.now().strftime("%d-%m-%Y_%H%M")
+    outputFileName=os.path.join(folder,f'{filename}_{now}.json')
+    with open(outputFileName, 'w') as f:
+        json.dump({'stages': stageReport, 'totalWallTime': round(sum(each['wallTime'] for each in stageReport), 4), 'peakRSS': peakRSS()}, f, indent=4)
+    print(f'Run report with {len(stageReport)} stage timings saved to {outputFileName}')
+    stageReport.clear()
+
+
+ruleKinds=['fill', 'cast', 'map', 'token', 'allowed', 'regex']
+valueRuleKinds={'map', 'token', 'allowed', 'regex'}
+
+
+def makeRuleStep(rule):
+    """Compile a single cleaning rule (one config entry) into a function over a Series of values
+
+    Args:
+        rule (dict): one of
+            {"fill": value}                                           replace nulls with value
+            {"cast": dtype}                                           convert to the given data type
+            {"map": {old: new}, "ignoreCase": bool}                   replace whole values
+            {"token": i, "delim": " "}                                take the i-th token when split on delim
+            {"allowed": [values], "default": value}                   replace values outside the allowed list with default
+            {"regex": pattern, "replace": value}                      regex substitution within values
+
+    Returns:
+        function: Series -> Series
+    """
+    kind=[each for each in ruleKinds if each in rule]
+    if len(kind)!=1:
+        raise ValueError(f'Cleaning rule must have exactly one of {ruleKinds}: {rule}')
+    kind=kind[0]
+    if kind=='fill':
+        return lambda values: values.fillna(rule['fill'])
+    if kind=='cast':
+        return lambda values: values.astype(rule['cast'])
+    if kind=='map':
+        if rule.get('ignoreCase', False):
+            lookup={str(key).lower(): value for key, value in rule['map'].items()}
+            return lambda values: values.mask(values.str.lower().isin(lookup), values.str.lower().map(lookup))
+        return lambda values: values.replace(rule['map'])
+    if kind=='token':
+        return lambda values: values.str.split(rule.get('delim', ' '), regex=False).str[rule['token']]
+    if kind=='allowed':
+        return lambda values: values.where(values.isin(rule['allowed']), rule['default'])
+    pattern=re.compile(rule['regex'])
+    return lambda values: values.str.replace(pattern, rule['replace'], regex=True)
+
+
+def compileRules(rules):
+    """Compile the cleaningRules section of the config once, into an ordered list of column operations for applyRules.
+    Each column's rules are applied in the order listed. A column may be derived from another (already cleaned) column via "source".
+
+    Args:
+        rules (dict): column name -> {"source": column (optional), "steps": [rule, ...]}, see makeRuleStep for the rule types
+
+    Returns:
+        list: (column, source column, list of step functions, whether any step works on whole values)
     """
-    for key in types_dict:
-        data[key]=data[key].astype(types_dict[key])
-    print ('Type conversion complete')
+    compiled=[]
+    for column, rule in rules.items():
+        steps=[makeRuleStep(each) for each in rule['steps']]
+        byValue=any(kind in each for each in rule['steps'] for kind in valueRuleKinds)
+        compiled.append((column, rule.get('source', column), steps, byValue))
+    return compiled
+
+
+@profileStage
+def applyRules(data, compiledRules):
+    """Apply compiled cleaning rules (from compileRules) to the base data, in place. Each column is read and written once.
+    Columns with only null fills and type casts are converted directly. Otherwise every step is evaluated once per distinct value and mapped back onto the records.
+    Rules for columns not present in the dataset (e.g. optional columns) are skipped.
+
+    Args:
+        data (DataFrame): Base data to be cleaned
+        compiledRules (list): output of compileRules
+    """
+    for column, source, steps, byValue in compiledRules:
+        if source not in data.columns:
+            continue
+        if byValue:
+            codes, uniques=pd.factorize(data[source], use_na_sentinel=False)
+            values=pd.Series(uniques, dtype=object)
+        else:
+            values=data[source]
+        for step in steps:
+            values=step(values)
+        data[column]=values.take(codes).set_axis(data.index) if byValue else values
+    print('Cleaning rules complete')
+
+
+def compactTypes(data, categoryFields):
+    """Store the given low-cardinality text fields as (dictionary-encoded) categoricals, in place. Fields not present in the dataset are skipped
+
+    Args:
+        data (DataFrame): Base or Marker table
+        categoryFields (list): names of fields to be stored as categoricals
+    """
+    for each in categoryFields:
+        if each in data.columns:
+            data[each]=data[each].astype('category')
 
 
 def groupSpecies(rowstring, grouplist):
@@ -35,7 +223,7 @@ def groupSpecies(rowstring, grouplist):
 
     Args:
         rowstring (str): listed species of the tree (human-inputted)
-        grouplist (list): accepted list of tree families 
+        grouplist (list or set): accepted list of tree families 
 
     Returns:
         str: identified tree family, or the original species
@@ -49,6 +237,69 @@ def groupSpecies(rowstring, grouplist):
     return str(intersect[0]).capitalize()
 
 
+def loadSpeciesLookup(lookupFile, grouplist):
+    """Load the persisted species to group lookup (see assignSpeciesGroups)
+
+    Args:
+        lookupFile (str): Location of the persisted species to group lookup (json)
+        grouplist (list or set): accepted list of tree families 
+
+    Returns:
+        dict: species spelling to group, empty if there is no lookup file or it was built from a different list of tree families
+    """
+    if not os.path.exists(lookupFile):
+        return {}
+    with open(lookupFile, 'r') as f:
+        stored=json.load(f)
+    return stored['lookup'] if sorted(stored['speciesGroups'])==sorted(set(grouplist)) else {}
+
+
+def updateSpeciesLookup(lookupFile, grouplist, newGroups):
+    """Add newly grouped species spellings to the persisted lookup e.g. those returned by assignSpeciesGroups in pool workers, which don't write to the file themselves
+
+    Args:
+        lookupFile (str): Location of the persisted species to group lookup (json)
+        grouplist (list or set): accepted list of tree families 
+        newGroups (dict): species spelling to group, for the spellings to add
+    """
+    if len(newGroups)==0:
+        return
+    lookup=loadSpeciesLookup(lookupFile, grouplist)
+    lookup.update(newGroups)
+    with open(lookupFile, 'w') as f:
+        json.dump({'speciesGroups': sorted(set(grouplist)), 'lookup': lookup}, f, indent=4)
+
+
+@profileStage
+def assignSpeciesGroups(data, grouplist, lookupFile=None, updateLookup=True):
+    """Create the SpeciesGroup column (in place) as a categorical. groupSpecies is only evaluated once per distinct Species spelling, and the results are mapped back onto every tree.
+    If a lookup file is given, previously grouped spellings are reused from it and only new spellings are computed, after which the file is updated. 
+    The stored lookup is discarded if it was built from a different list of tree families.
+
+    Args:
+        data (DataFrame): Base data including Species (text, nulls already handled)
+        grouplist (list): accepted list of tree families 
+        lookupFile (str, optional): Location of the persisted species to group lookup (json). Defaults to None (no persistence).
+        updateLookup (bool, optional): Write newly grouped spellings back to the lookup file. Disable where several processes share one lookup file 
+            (and merge the returned spellings with updateSpeciesLookup instead). Defaults to True.
+
+    Returns:
+        dict: species spelling to group, for the spellings newly grouped
+    """
+    groupSet=set(grouplist)
+    lookup=loadSpeciesLookup(lookupFile, groupSet) if lookupFile is not None else {}
+
+    newGroups={each: groupSpecies(each, groupSet) for each in data.Species.unique() if each not in lookup}
+    lookup.update(newGroups)
+    data['SpeciesGroup']=data.Species.map(lookup).astype('category')
+
+    if lookupFile is not None and updateLookup:
+        updateSpeciesLookup(lookupFile, groupSet, newGroups)
+    print(f'Species grouping complete ({len(newGroups)} new species spellings grouped)')
+    return newGroups
+
+
+@profileStage
 def createBoolFlag(data, fields):
     """For a given list of fields, which in their raw form are concatenated markers, generate boolean flag columns indicating whether any markers are listed
 
@@ -62,98 +313,447 @@ def createBoolFlag(data, fields):
     print ('Boolean flags generated for '+', '.join(fields))
 
 
-def livingStatusFlags(row):
-    """Lambda function - Use the LivingStatus information (single-choice field with free-form 'other' text) to generate Alive/Dead categorical column and also generate Ashdieback column
+@profileStage
+def livingStatusFlags(data):
+    """Use the LivingStatus information (single-choice field with free-form 'other' text) to generate Alive/Dead categorical column and also generate Ashdieback column.
+    Columns are derived in place with vectorised string matching across the whole table, rather than row by row.
 
     Args:
-        row (DataFrame row): including LivingStatus and SpeciesGroup (both text)
-
-    Returns:
-        DataFrame row: original row with additional columns LivingGroup and AshDieback
+        data (DataFrame): Base data including LivingStatus and SpeciesGroup (both text)
     """
-    testcase=row.LivingStatus.lower()
-    if 'alive' in testcase:
-        row['LivingGroup']='Alive'
-    elif 'dead' in testcase:
-        row['LivingGroup']='Dead'
-    else:
-        row['LivingGroup']='Unknown'
+    testcase=data.LivingStatus.str.lower()
+    data['LivingGroup']=np.select([testcase.str.contains('alive', regex=False), testcase.str.contains('dead', regex=False)],
+                                  ['Alive', 'Dead'], 'Unknown')
 
-    if 'chalara fraxinea' in testcase:
-        if 'confirmed' in testcase:
-            row['AshDieback']='Confirmed'
-        else:
-            row['AshDieback']='Suspected'
-    elif 'Ash' in row.SpeciesGroup:
-        row['AshDieback']='Unknown'
-    else:
-        row['AshDieback']='N/A'
+    ashDieback=testcase.str.contains('chalara fraxinea', regex=False)
+    data['AshDieback']=np.select([ashDieback & testcase.str.contains('confirmed', regex=False), ashDieback, data.SpeciesGroup.str.contains('Ash', regex=False)],
+                                 ['Confirmed', 'Suspected', 'Unknown'], 'N/A')
+    print('new LivingStatus columns complete')
 
-    return row
-        
-def fixDates(data, datecols, null_value='12/31/9999 12:00:00 AM'):
-    """Convert date format from US to UK format and add null handling. In-place correction of date columns
+
+@profileStage
+def fixDates(data, datecols, null_value='12/31/9999 12:00:00 AM', addDatetimes=False):
+    """Convert date format from US to UK format and add null handling. In-place correction of date columns.
+    Each distinct timestamp is parsed only once, with the results mapped back onto every row.
 
     Args:
         data (DataFrame): base data including at least one date column in US format
         datecols (list): date field names to be reformatted
         null_value (str, optional): Value with which to replace nulls. Defaults to '12/31/9999 12:00:00 AM'.
+        addDatetimes (bool, optional): Also add a datetime64 column per date field (suffixed DT), with nulls left as NaT. Defaults to False.
     """
+    dateFormat='%m/%d/%Y %H:%M:%S %p'
     for each in datecols:
         # Date fields appear to be in mm/dd/yyyy format. No indication that it is inconsistent, therefore we will treat these uniformly
         # Set null value as 31/12/9999
-        data[each]=np.where(data[each]=='nan', null_value, data[each])
-        data[each]=data[each].apply(lambda x:  dt.datetime.strptime(x, '%m/%d/%Y %H:%M:%S %p').strftime('%d/%m/%Y'))
-
-
-
-def makePivot(data, col, delim):
-    """Given a dataset with a target column containing concatenated text markers, perform a split based on given delimiter to create many columns, 
-    then perform a melt to convert this into a long (instead of wide) format with one row for every listed value for every original tree (Id). 
-    Trees with no markers will not exist in the output table.
+        values=data[each].where((data[each]!='nan') & data[each].notnull(), null_value)
+        codes, uniqueDates=pd.factorize(values)
+        uniqueDates=pd.Series(uniqueDates)
+        parsed=pd.to_datetime(uniqueDates, format=dateFormat, errors='coerce')
+        formatted=parsed.dt.strftime('%d/%m/%Y').to_numpy(dtype=object)
+        # dates outside the pandas datetime range (e.g. the 9999 null value) can't be parsed in bulk - these few are converted individually, raising on anything unparseable
+        outOfRange=parsed.isnull().to_numpy()
+        formatted[outOfRange]=[dt.datetime.strptime(x, dateFormat).strftime('%d/%m/%Y') for x in uniqueDates[outOfRange]]
+        data[each]=formatted[codes]
+        if addDatetimes:
+            data[each+'DT']=parsed.dt.normalize().to_numpy()[codes]
+
+
+def makePivot(data, col, delim, keepPosition=False):
+    """Given a dataset with a target column containing concatenated text markers, split on the given delimiter and flatten into a long (instead of wide) format 
+    with one row for every listed value for every original tree (Id). Trees with no markers will not exist in the output table.
+    Rows are ordered as per a split-then-melt (all first markers, then all second markers etc.) without building the intermediate wide table or exploded copies of the data.
 
     Args:
         data (DataFrame): Base data, one record per tree (Id)
         col (str): name of the column to split/pivot
         delim (str): the text delimiter used to list markers in the given column, used to perform a split operation
+        keepPosition (bool, optional): add a position column, holding the position of each marker within its tree's list. Defaults to False.
 
     Returns:
-        DataFrame: long-format dataframe with tree columns: Id, value, variable
+        DataFrame: long-format dataframe with tree columns: Id, variable, value (and position, if kept)
     """
     #assumes column has already had null handling and data type applied so filters based on null strings
-    subset=data[~data[col].isin(['Unknown', 'nan'])].copy()
-    pivot=pd.melt(pd.concat([subset.Id, subset[col].str.split(delim, expand=True)], axis=1), id_vars=['Id'])
-    pivot=pivot[~pivot.value.isnull()].drop_duplicates()
-    pivot.variable=col
+    keep=~data[col].isin(['Unknown', 'nan']) & data[col].notnull()
+    markerLists=data.loc[keep, col].str.split(delim, regex=False)
+    counts=markerLists.str.len().to_numpy(dtype=np.int64)
+    # flatten the marker lists into single arrays, tracking the tree and position within the list of every marker
+    values=np.fromiter(itertools.chain.from_iterable(markerLists), dtype=object, count=counts.sum())
+    tree=np.repeat(np.arange(len(counts)), counts)
+    position=np.arange(len(values))-np.repeat(np.cumsum(counts)-counts, counts)
+    order=np.lexsort((tree, position))
+    columns={'Id': data.loc[keep, 'Id'].to_numpy()[tree[order]], 'variable': col, 'value': values[order]}
+    if keepPosition:
+        columns['position']=position[order]
+    pivot=pd.DataFrame(columns)
+    # duplicate markers can only arise from duplicated trees (Ids)
+    if not data.Id.is_unique:
+        pivot=pivot[~pd.DataFrame({'Id': pivot.Id, 'position': position[order], 'value': pivot.value}).duplicated()].reset_index(drop=True)
     return pivot
 
-def createMarkerTable(data, colDict, strDict={"''":"'", "â€™":"'", "â€“":"-"}):
+@profileStage
+def createMarkerTable(data, colDict, strDict={}, keepPosition=False):
     """Given a dataset containing text attribute columns composed of concatenated markers, create a long-format table with one row for every marker value across each attribute per tree
-        This concatenates the DataFrame outputs of the makePivot function.
+        This concatenates the DataFrame outputs of the makePivot function (once, after all attributes are pivoted).
 
     Args:
         data (DataFrame): Base data, one record per tree (Id), with attribute columns containing concatenated markers
         colDict (dictionary): lookup of column names and the delimiters used to separate each marker within them
-        strDict (dictionary) : lookup of text replacements required within markerValues. Defaults to {"''":"'", "â€™":"'", "â€“":"-"} 
+        strDict (dictionary) : lookup of plain text replacements required within markerValues, applied in order e.g. to fix mis-encoded characters 
+            (see markerReplacements in the config). Defaults to {} (no replacements).
+        keepPosition (bool, optional): add a MarkerPosition column, holding the position of each marker within its tree's list - used to merge the marker tables 
+            of separate batches (see combineBatches). Defaults to False.
     Returns:
         DataFrame: long-form pivot table with one row per marker value, per attribute, per tree (Id)
     """
-    output=pd.DataFrame(columns=['Id', 'variable', 'value'])
-    for each in colDict:
-        pivot=makePivot(data, each, colDict[each])
-        output=pd.concat([output, pivot], axis=0)
-    output=output.rename(columns={'variable': 'MarkerType', 'value':'MarkerValue'})
-    # TO DO - add section replacing incorrect strings in MarkerValue
-    output.MarkerValue=output.MarkerValue.replace(strDict, regex=True)
+    pivots=[makePivot(data, each, colDict[each], keepPosition) for each in colDict]
+    output=pd.concat(pivots, axis=0, ignore_index=True) if len(pivots)>0 else pd.DataFrame(columns=['Id', 'variable', 'value', *(['position'] if keepPosition else [])])
+    output=output.rename(columns={'variable': 'MarkerType', 'value':'MarkerValue', 'position': 'MarkerPosition'})
+    # replace incorrect strings in MarkerValue - done once per distinct value
+    codes, markerValues=pd.factorize(output.MarkerValue)
+    markerValues=pd.Series(markerValues, dtype=object)
+    for each in strDict:
+        markerValues=markerValues.str.replace(each, strDict[each], regex=False)
+    output['MarkerValue']=markerValues.to_numpy()[codes]
     return output
 
 
 
-def fetchPolygons(files={'uki_regionfile':'./Data/AncientTrees/Europe_NUTs_2021/NUTS_RG_20M_2021_3035.shp', 'guernsey_regionfile':'./Data/AncientTrees/princeton_Guernsey_shapefile/GGY_adm0.shp', 'iom_regionfile':'./Data/AncientTrees/stanford_IoM_shapefile/nk743nh6214.shp'}, outputfolder='./Data/AncientTrees/VisRegions/', outputfile='region_polygons.shp'):
-    """If combined shapefile with all target regions exists, load it into a GeoDataFrame. Otherwise, use given shape file download locations to create a combined set of regions covering the target area of the Ancient Tree Inventory. 
+def splitBatches(data, nBatches):
+    """Partition a dataset by row into (roughly) equal, contiguous batches, e.g. to be processed in parallel
+
+    Args:
+        data (DataFrame): dataset to be partitioned
+        nBatches (int): number of batches required
+
+    Returns:
+        list of DataFrames: row batches, in their original order
+    """
+    bounds=np.linspace(0, len(data), nBatches+1).astype(int)
+    return [data.iloc[bounds[i]:bounds[i+1]] for i in range(nBatches) if bounds[i+1]>bounds[i]]
+
+
+def combineBatches(baseTables, markerTables, colDict, idOrder=None, keepPosition=False):
+    """Merge the Base and Marker tables produced from separate row batches (see splitBatches) so that the result matches processing the full dataset in one pass.
+    Base records are kept in batch order. Marker records are re-ordered by marker type (in colDict order), then position of the marker within each tree's list, then tree - 
+    as per createMarkerTable.
+
+    Args:
+        baseTables (list of DataFrames): Base table per batch, in batch order
+        markerTables (list of DataFrames): Marker table per batch, in batch order. Positions of markers within each tree's list are taken from MarkerPosition where kept 
+            (see createMarkerTable), otherwise counted within each batch
+        colDict (dictionary): lookup of marker column names and delimiters, as used to create the marker tables
+        idOrder (Series, optional): lookup of Id to tree position, used to order trees where the batches are not contiguous (e.g. incremental runs). Defaults to None (batch order).
+        keepPosition (bool, optional): keep the MarkerPosition column in the combined Marker table. Defaults to False.
+
+    Returns:
+        DataFrame, DataFrame: combined Base table and Marker table
+    """
+    base=pd.concat(baseTables, axis=0, ignore_index=True)
+    # categories differ between batches, so are rebuilt across the combined table
+    for each in baseTables[0].select_dtypes('category').columns:
+        base[each]=base[each].astype('category')
+
+    markers=pd.concat(markerTables, axis=0, ignore_index=True)
+    for each in markerTables[0].select_dtypes('category').columns:
+        markers[each]=markers[each].astype('category')
+    markers['MarkerPosition']=np.concatenate([each.MarkerPosition.to_numpy(dtype=np.int64) if 'MarkerPosition' in each.columns 
+                                              else each.groupby(['MarkerType', 'Id'], sort=False, observed=True).cumcount().to_numpy() for each in markerTables])
+    if idOrder is not None:
+        base=base.iloc[np.argsort(base.Id.map(idOrder).to_numpy(), kind='stable')].reset_index(drop=True)
+        markers=markers.iloc[np.argsort(markers.Id.map(idOrder).to_numpy(), kind='stable')]
+    # a repeated Id can span batches, so duplicate markers are dropped across the combined table as well as within each batch (see makePivot)
+    if not base.Id.is_unique:
+        markers=markers[~markers.duplicated(['MarkerType', 'Id', 'MarkerPosition', 'MarkerValue'])]
+    typeOrder=markers.MarkerType.map({each:i for i, each in enumerate(colDict)}).to_numpy()
+    # lexsort is stable, so batch/tree order is kept within each marker type and position
+    markers=markers.iloc[np.lexsort((markers.MarkerPosition.to_numpy(), typeOrder))].reset_index(drop=True)
+    if not keepPosition:
+        markers=markers.drop(columns='MarkerPosition')
+    return base, markers
+
+
+def dropRepeatedMarkers(markers, ids, keptMarkers):
+    """Drop the markers of repeated trees (Ids) which have already been kept from an earlier batch, for batches which are saved separately (e.g. chunks) - 
+    so that the result matches the duplicate handling of a single pass (see makePivot)
+
+    Args:
+        markers (DataFrame): Marker table of the batch, with MarkerPosition (see createMarkerTable)
+        ids (set): Ids repeated anywhere across the batches
+        keptMarkers (set): MarkerType, Id, MarkerPosition and MarkerValue of every marker of a repeated tree kept so far, updated with those kept from this batch
+
+    Returns:
+        DataFrame: Marker table without the markers already kept, or the MarkerPosition column
+    """
+    repeated=np.flatnonzero(markers.Id.isin(ids).to_numpy())
+    keys=list(zip(*(markers[each].to_numpy()[repeated] for each in ['MarkerType', 'Id', 'MarkerPosition', 'MarkerValue'])))
+    keep=np.ones(len(markers), dtype=bool)
+    keep[repeated]=[each not in keptMarkers for each in keys]
+    keptMarkers.update(keys)
+    return markers[keep].drop(columns='MarkerPosition').reset_index(drop=True)
+
+
+def sortAggregate(counts, dimensions):
+    """Convert the dimension values of an aggregate table to text and sort the rows by dimension, so that aggregates from different sources / data types match
+
+    Args:
+        counts (DataFrame): aggregate table
+        dimensions (list): dimension fields of the aggregate
+
+    Returns:
+        DataFrame: aggregate table with text dimensions, sorted
+    """
+    counts[dimensions]=counts[dimensions].astype(str)
+    measures=[each for each in counts.columns if each not in dimensions]
+    return counts.astype({each: 'int64' for each in measures}).sort_values(dimensions, ignore_index=True)
+
+
+@profileStage
+def aggregateTrees(baseData, dimensions):
+    """Count trees per combination of the given Base table fields (e.g. region x species group x status), for dashboards to read in place of the per-tree extract.
+    Records are grouped on their stored values (text, categorical or Arrow-backed), only the aggregate is converted to text.
+
+    Args:
+        baseData (DataFrame): Base table
+        dimensions (list): Base table fields to count by
+
+    Returns:
+        DataFrame: one row per combination present, with TreeCount. Dimension values are text, rows sorted by dimension
+    """
+    counts=baseData.groupby(dimensions, observed=True, dropna=False).size()
+    return sortAggregate(counts.rename('TreeCount').reset_index(), dimensions)
+
+
+@profileStage
+def aggregateMarkers(baseData, markerTable, dimensions):
+    """Count markers per combination of the given fields (e.g. region x MarkerType x MarkerValue). Fields in the Base table are taken from the tree's record, the rest from the Marker table.
+    MarkerCount counts every marker, TreeCount counts the trees with that marker (trees can list the same marker more than once)
+
+    Args:
+        baseData (DataFrame): Base table
+        markerTable (DataFrame): Marker table
+        dimensions (list): Marker / Base table fields to count by
+
+    Returns:
+        DataFrame: one row per combination present, with MarkerCount and TreeCount. Dimension values are text, rows sorted by dimension
+    """
+    treeFields=[each for each in dimensions if each in baseData.columns]
+    trees=baseData.drop_duplicates('Id')
+    # position of each marker's tree, to take the tree fields without converting them
+    position=pd.Index(trees.Id).get_indexer(markerTable.Id)
+    markers=pd.DataFrame({each: (trees[each].array.take(position, allow_fill=True) if each in treeFields else markerTable[each].array) for each in dimensions})
+    markers['Id']=markerTable.Id.array
+    counts=markers.groupby(dimensions, observed=True, dropna=False).agg(MarkerCount=('Id', 'size'), TreeCount=('Id', 'nunique'))
+    return sortAggregate(counts.reset_index(), dimensions)
+
+
+def combineAggregates(tables, dimensions, removeTables=[]):
+    """Maintain aggregate tables (see aggregateTrees / aggregateMarkers) without recounting every record - counts are summed across tables covering separate sets of trees, 
+    and the counts of removed trees subtracted. Combinations left with no trees are dropped.
+
+    Args:
+        tables (list of DataFrames): aggregates to add together e.g. the previous run and the new/changed records, or one per chunk
+        dimensions (list): dimension fields of the aggregates
+        removeTables (list of DataFrames, optional): aggregates of trees to remove e.g. changed/deleted records as per the previous run. Defaults to [].
+
+    Returns:
+        DataFrame: combined aggregate, rows sorted by dimension
+    """
+    measures=[each for each in tables[0].columns if each not in dimensions]
+    removed=[each.assign(**{measure: -each[measure].astype('int64') for measure in measures}) for each in removeTables]
+    combined=pd.concat([each.astype({measure: 'int64' for measure in measures}) for each in tables]+removed, ignore_index=True)
+    combined[dimensions]=combined[dimensions].astype(str)
+    combined=combined.groupby(dimensions, sort=True)[measures].sum().reset_index()
+    return combined[(combined[measures]!=0).any(axis=1)].reset_index(drop=True)
+
+
+def hashRows(data, idName='Id'):
+    """Generate a change manifest for the raw data - one hash per record, covering every column, keyed on the record ID
+
+    The hashes depend on the dtype of each column (1 vs 1.0, NaN in a float vs an object column), so read the download with fixed dtypes - with inferred dtypes
+    a manifest from one chunk would not be comparable with one from the whole file.
+
+    Args:
+        data (DataFrame): raw dataset (as downloaded, before any transformation)
+        idName (str, optional): Name of the primary ID field. Defaults to 'Id'.
+
+    Returns:
+        DataFrame: manifest with columns Id and RowHash (both text)
+    """
+    rowHash=pd.util.hash_pandas_object(data, index=False)
+    return pd.DataFrame({idName: data[idName].astype(str).to_numpy(), 'RowHash': rowHash.astype(str).to_numpy()})
+
+
+def compareManifests(newManifest, oldManifest, idName='Id'):
+    """Compare the change manifests of two downloads to find the records which need reprocessing
+
+    Args:
+        newManifest (DataFrame): manifest of the current download (see hashRows)
+        oldManifest (DataFrame): manifest of the previously processed download
+        idName (str, optional): Name of the primary ID field. Defaults to 'Id'.
+
+    Returns:
+        set, set: IDs which are new or changed, IDs which have been deleted
+    """
+    merged=newManifest.merge(oldManifest, on=idName, how='outer', suffixes=('', 'Old'), indicator=True)
+    changed=set(merged.loc[(merged._merge=='left_only')|((merged._merge=='both')&(merged.RowHash!=merged.RowHashOld)), idName])
+    deleted=set(merged.loc[merged._merge=='right_only', idName])
+    print(f'Change manifest: {len(changed)} new or changed records, {len(deleted)} deleted records')
+    return changed, deleted
+
+
+def findLatestFile(folder, filename, fileFormat='csv'):
+    """Find the most recently saved output for the given file name (as written by saveFile)
+
+    Args:
+        folder (string): output folder location
+        filename (string): file name, without timestamp suffix
+        fileFormat (string, optional): output file type (csv/parquet/partitioned). Defaults to csv
+
+    Returns:
+        string: path to the latest file, or None if there isn't one
+    """
+    extension='csv' if fileFormat=='csv' else 'parquet'
+    candidates=glob.glob(os.path.join(folder, f'{filename}_*.{extension}'))
+    if len(candidates)==0:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+def loadFile(path, fileFormat='csv', columns=None):
+    """Load an output previously written by saveFile. csv outputs are read as text exactly as written, so that they can be re-saved unchanged
+
+    Args:
+        path (string): file location
+        fileFormat (string, optional): file type (csv/parquet/partitioned). Defaults to csv
+        columns (list, optional): only load these columns. Defaults to None (all columns).
+
+    Returns:
+        DataFrame: loaded data
+    """
+    if fileFormat=='csv':
+        return pd.read_csv(path, dtype=str, keep_default_na=False, usecols=columns)
+    return pd.read_parquet(path, columns=columns)
+
+
+
+def writeCheckpoint(data, filename, folder, append=False):
+    """Checkpoint a finished table as an (uncompressed) Arrow IPC file, which later stages and other processes can memory-map with readCheckpoint rather than re-parsing the outputs.
+    Each call writes one part file within a folder named as the checkpoint. Files are written under a temporary name and then renamed, so readers never see a partial file.
+
+    Args:
+        data (DataFrame): table to checkpoint e.g. Base or Marker table
+        filename (string): checkpoint name e.g. ATI_Base_table
+        folder (string): checkpoint folder location
+        append (bool, optional): add a part to the existing checkpoint (e.g. one per chunk) rather than replacing it. Defaults to False.
+    """
+    import pyarrow as pa
+    checkpointPath=os.path.join(folder, filename)
+    os.makedirs(checkpointPath, exist_ok=True)
+    parts=sorted(glob.glob(os.path.join(checkpointPath, 'part-*.arrow')))
+    if not append:
+        for each in parts:
+            os.remove(each)
+        parts=[]
+    arrays={}
+    for each in data.columns:
+        try:
+            arrays[each]=pa.array(data[each], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # mixed types (e.g. text from a previous csv output alongside newly processed numbers) are stored as text, as they would be written to csv
+            arrays[each]=pa.array(data[each].where(data[each].isnull(), data[each].astype(str)), from_pandas=True)
+    table=pa.table(arrays)
+    partPath=os.path.join(checkpointPath, f'part-{len(parts):05d}.arrow')
+    with pa.OSFile(partPath+'.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(partPath+'.tmp', partPath)
+    print(f'{filename} checkpoint saved with {len(data)} records to {partPath}')
+
+
+def readCheckpoint(filename, folder, columns=None):
+    """Memory-map a checkpoint written by writeCheckpoint. Text columns are returned Arrow-backed (string[pyarrow]) and numeric columns without nulls as views,
+    so the table data stays in the (shared, read-only) file pages rather than being copied into the process. Categoricals are rebuilt from their codes.
+
+    Args:
+        filename (string): checkpoint name e.g. ATI_Base_table
+        folder (string): checkpoint folder location
+        columns (list, optional): only load these columns. Defaults to None (all columns).
+
+    Returns:
+        DataFrame: checkpointed table, or None if there is no checkpoint
+    """
+    import pyarrow as pa
+    parts=sorted(glob.glob(os.path.join(folder, filename, 'part-*.arrow')))
+    if len(parts)==0:
+        return None
+    textTypes={pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}
+    tables=[]
+    for each in parts:
+        table=pa.ipc.open_file(pa.memory_map(each, 'r')).read_all()
+        if columns is not None:
+            table=table.select(columns)
+        tables.append(table)
+    if len(tables)>1:
+        # parts (e.g. chunks) are combined as Arrow chunks, without copying - with their dictionaries unified so categoricals stay categoricals. 
+        # Columns which are all null in a part, or with a wider dictionary index, are first cast to the common type
+        widen=lambda field: field.with_type(pa.dictionary(pa.int32(), field.type.value_type)) if pa.types.is_dictionary(field.type) else field
+        try:
+            schema=pa.unify_schemas([pa.schema([widen(field) for field in each.schema], each.schema.metadata) for each in tables])
+            tables=[pa.concat_tables([each.cast(schema) for each in tables]).unify_dictionaries()]
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # columns stored as different types in different parts (see writeCheckpoint) are left to pandas to combine
+            return pd.concat([each.to_pandas(types_mapper=textTypes.get, split_blocks=True) for each in tables], ignore_index=True)
+    return tables[0].to_pandas(types_mapper=textTypes.get, split_blocks=True)
+
+
+def fingerprintFiles(paths, extras=''):
+    """Generate a fingerprint of the given shape files (including their .shx/.dbf/.prj companions), used to tell whether a cache built from them is stale
+
+    Args:
+        paths (list): shape file locations
+        extras (str, optional): any other settings which should invalidate the cache when changed. Defaults to ''.
+
+    Returns:
+        str: hex digest of the file contents, or None if any of the files are missing
+    """
+    fingerprint=hashlib.sha256(extras.encode())
+    for path in paths:
+        if not os.path.exists(path):
+            return None
+        stem=os.path.splitext(path)[0]
+        for ext in ['.shp', '.shx', '.dbf', '.prj']:
+            if os.path.exists(stem+ext):
+                with open(stem+ext, 'rb') as f:
+                    fingerprint.update(f.read())
+    return fingerprint.hexdigest()
+
+
+def fingerprintSettings(settings, polygons=None):
+    """Generate a fingerprint of the settings (and region polygons) which derived values depend on, used to tell whether the outputs of a previous run can be reused
+
+    Args:
+        settings (dict): settings to include - any json-serialisable values
+        polygons (GeoDataFrame, optional): region polygons to include. Defaults to None.
+
+    Returns:
+        str: hex digest of the settings and polygons
+    """
+    fingerprint=hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    if polygons is not None:
+        # geometries as hex WKB alongside the other fields, so a change in either invalidates the fingerprint
+        fingerprint.update(pd.DataFrame(polygons.to_wkb(hex=True)).to_csv(index=False).encode())
+    return fingerprint.hexdigest()
+
+
+@profileStage
+def fetchPolygons(files={'uki_regionfile':'./Data/AncientTrees/Europe_NUTs_2021/NUTS_RG_20M_2021_3035.shp', 'guernsey_regionfile':'./Data/AncientTrees/princeton_Guernsey_shapefile/GGY_adm0.shp', 'iom_regionfile':'./Data/AncientTrees/stanford_IoM_shapefile/nk743nh6214.shp'}, outputfolder='./Data/AncientTrees/VisRegions/', outputfile='region_polygons.shp', cachefile='region_polygons.parquet', simplifyTolerance=100):
+    """If an up-to-date cache of the combined target regions exists, load it into a GeoDataFrame. Otherwise, use given shape file download locations to create a combined set of regions covering the target area of the Ancient Tree Inventory. 
     These inputs cover the NUTs regions of all of Europe (2021) - which needs to be filtered for the UK & Ireland, a shapefile for the Isle of Man, and a shapefile of Guernsey
     Note - shape files must be pre-downloaded, cannot be scraped. 
-    Output is saved as shapefile (.shp) to chosen location.
+    Output is saved as shapefile (.shp) to chosen location if not already there, and cached as GeoParquet along with a simplified copy of each geometry and a fingerprint of the source shape files - 
+    the cache is rebuilt automatically whenever the source files change. If the source files aren't available, the existing cache (or failing that, the combined shapefile) is used as is.
+    Polygon geometries are returned prepared, ready for repeated spatial predicates.
 
     File sources:
         NUTs Europe 2021 : https://ec.europa.eu/eurostat/web/gisco/geodata/reference-data/administrative-units-statistical-units/nuts
@@ -163,128 +763,179 @@ def fetchPolygons(files={'uki_regionfile':'./Data/AncientTrees/Europe_NUTs_2021/
 
     Args:
         files (dict, optional): Locations for pre-downloaded shape files covering NUTs (Europe), Isle of Man, and Guernsey. Defaults to {'uki':'./Data/AncientTrees/All_Nuts_2021/NUTS_RG_20M_2021_3035.shp', 'Guernsey':'./Data/AncientTrees/princeton_Guernsey_shapefile/GGY_adm0.shp', 'IoM':'./Data/AncientTrees/stanford_IoM_shapefile/nk743nh6214.shp'}.
-        outputfolder (str, optional): _description_. Defaults to './Data/AncientTrees/VisRegions/'.
-        outputfile (str, optional): _description_. Defaults to 'region_polygons.shp'.
+        outputfolder (str, optional): Folder for the combined region outputs. Defaults to './Data/AncientTrees/VisRegions/'.
+        outputfile (str, optional): File name of the combined shapefile. Defaults to 'region_polygons.shp'.
+        cachefile (str, optional): File name of the GeoParquet cache. Defaults to 'region_polygons.parquet'.
+        simplifyTolerance (float, optional): Tolerance (metres) of the simplified geometry column (SimplifiedGeometry) stored in the cache. Defaults to 100.
 
     Returns:
         GeoDataFrame: Geodataframe containing required regions, ID/Name/Country and polygon geometry in the British National Grid crs (EPSG:27700)
     """
-    if os.path.exists(outputfolder+outputfile) :
-        regionPolygons=gpd.read_file(outputfolder+outputfile)
+    import geopandas as gpd
+    import shapely
+    import pyarrow.parquet as pq
+    shapefilePath=os.path.join(outputfolder, outputfile)
+    cachePath=os.path.join(outputfolder, cachefile)
+    fingerprint=fingerprintFiles([files['uki_regionfile'], files['iom_regionfile'], files['guernsey_regionfile']], f'simplifyTolerance={simplifyTolerance}')
+
+    if os.path.exists(cachePath) and (fingerprint is None or pq.read_schema(cachePath).metadata.get(b'source_fingerprint', b'').decode()==fingerprint):
+        regionPolygons=gpd.read_parquet(cachePath)
 
     else:
-        # see other documentation for the original location of these files
-        uki=gpd.read_file(files['uki_regionfile'])
-        uki=uki[(((uki.CNTR_CODE=='IE')|(uki.NUTS_ID.str.contains('UKM')))&(uki.LEVL_CODE==2))|((uki.CNTR_CODE=='UK')&(uki.LEVL_CODE==1)&(uki.NUTS_ID!='UKM'))].reset_index()
-        IoM=gpd.read_file(files['iom_regionfile'])
-        Guernsey=gpd.read_file(files['guernsey_regionfile'])
-        # Ensure all are in same british national grid projection 27700, which matches x and y in ATI data
-        uki.crs='EPSG:3035'
-        uki=uki.to_crs('EPSG:27700')
-        IoM.crs='EPSG:4326'
-        IoM=IoM.to_crs('EPSG:27700')
-        Guernsey.crs='EPSG:4326'
-        Guernsey=Guernsey.to_crs('EPSG:27700')
+        if fingerprint is None and os.path.exists(shapefilePath):
+            # no cache, and the source files aren't available to rebuild from - build it from the existing combined shapefile as is 
+            # (it is stamped with no fingerprint, so it is rebuilt from the sources once they are available)
+            regionPolygons=gpd.read_file(shapefilePath)
+        else:
+            # see other documentation for the original location of these files
+            uki=gpd.read_file(files['uki_regionfile'])
+            uki=uki[(((uki.CNTR_CODE=='IE')|(uki.NUTS_ID.str.contains('UKM')))&(uki.LEVL_CODE==2))|((uki.CNTR_CODE=='UK')&(uki.LEVL_CODE==1)&(uki.NUTS_ID!='UKM'))].reset_index()
+            IoM=gpd.read_file(files['iom_regionfile'])
+            Guernsey=gpd.read_file(files['guernsey_regionfile'])
+            # Ensure all are in same british national grid projection 27700, which matches x and y in ATI data
+            uki.crs='EPSG:3035'
+            uki=uki.to_crs('EPSG:27700')
+            IoM.crs='EPSG:4326'
+            IoM=IoM.to_crs('EPSG:27700')
+            Guernsey.crs='EPSG:4326'
+            Guernsey=Guernsey.to_crs('EPSG:27700')
     
-        #Combine into one list
-        cols=['NUTS_ID', 'CNTR_CODE', 'NUTS_NAME', 'geometry']
-        IoM=IoM.rename(columns={'name_fao': 'NUTS_NAME', 'iso':'NUTS_ID'})
-        IoM['CNTR_CODE']=IoM.NUTS_ID
-        Guernsey=Guernsey.rename(columns={'NAME_ENGLI': 'NUTS_NAME', 'ISO':'NUTS_ID'})
-        Guernsey['CNTR_CODE']=Guernsey.NUTS_ID
-        regionPolygons=pd.concat([uki[cols], IoM[cols], Guernsey[cols]],ignore_index=True, axis=0)
-
-        # get Country
-        regionPolygons['Country']=regionPolygons.apply(lambda x: ['Replublic of Ireland'] if x.CNTR_CODE=='IE' else ['Scotland'] if 'UKM' in x.NUTS_ID else
-                 re.findall(r'England|Scotland|Wales|Northern Ireland|Isle of Man|Guernsey+', x.NUTS_NAME), axis=1)
-        regionPolygons['Country']=regionPolygons.Country.apply(lambda x: 'England' if len(x)==0 else x[0] )
-        regionPolygons['CountryHL']=np.where(regionPolygons.Country.isin(['England', 'Scotland', 'Wales', 'Northern Ireland']), 'UK', regionPolygons.Country)
-        regionPolygons=regionPolygons.rename(columns={'NUTS_NAME': 'RegionName', 'NUTS_ID': 'RegionID'})
-        regionPolygons.RegionName=regionPolygons[['Country', 'RegionName']].apply(lambda x: x.RegionName if len(re.findall(r'England|Scotland|Wales|Northern Ireland|Isle of Man|Guernsey+', x.RegionName))>0 else x.RegionName+' ('+x.Country+')', axis=1)
-
-        if not  os.path.exists(outputfolder) :
-            os.makedirs(outputfolder)
-        regionPolygons.to_file(outputfolder+outputfile)
-
+            #Combine into one list
+            cols=['NUTS_ID', 'CNTR_CODE', 'NUTS_NAME', 'geometry']
+            IoM=IoM.rename(columns={'name_fao': 'NUTS_NAME', 'iso':'NUTS_ID'})
+            IoM['CNTR_CODE']=IoM.NUTS_ID
+            Guernsey=Guernsey.rename(columns={'NAME_ENGLI': 'NUTS_NAME', 'ISO':'NUTS_ID'})
+            Guernsey['CNTR_CODE']=Guernsey.NUTS_ID
+            regionPolygons=pd.concat([uki[cols], IoM[cols], Guernsey[cols]],ignore_index=True, axis=0)
+
+            # get Country
+            regionPolygons['Country']=regionPolygons.apply(lambda x: ['Replublic of Ireland'] if x.CNTR_CODE=='IE' else ['Scotland'] if 'UKM' in x.NUTS_ID else
+                     re.findall(r'England|Scotland|Wales|Northern Ireland|Isle of Man|Guernsey+', x.NUTS_NAME), axis=1)
+            regionPolygons['Country']=regionPolygons.Country.apply(lambda x: 'England' if len(x)==0 else x[0] )
+            regionPolygons['CountryHL']=np.where(regionPolygons.Country.isin(['England', 'Scotland', 'Wales', 'Northern Ireland']), 'UK', regionPolygons.Country)
+            regionPolygons=regionPolygons.rename(columns={'NUTS_NAME': 'RegionName', 'NUTS_ID': 'RegionID'})
+            regionPolygons.RegionName=regionPolygons[['Country', 'RegionName']].apply(lambda x: x.RegionName if len(re.findall(r'England|Scotland|Wales|Northern Ireland|Isle of Man|Guernsey+', x.RegionName))>0 else x.RegionName+' ('+x.Country+')', axis=1)
+
+            # the shapefile is only written when missing - the cache is the copy kept up to date with the sources
+            if not os.path.exists(shapefilePath):
+                if not  os.path.exists(outputfolder) :
+                    os.makedirs(outputfolder)
+                regionPolygons.to_file(shapefilePath)
+
+        regionPolygons['SimplifiedGeometry']=regionPolygons.geometry.simplify(simplifyTolerance)
+        regionPolygons.to_parquet(cachePath)
+        # store the source fingerprint in the parquet metadata, so staleness can be checked without loading the cache
+        cache=pq.read_table(cachePath)
+        pq.write_table(cache.replace_schema_metadata({**cache.schema.metadata, b'source_fingerprint': str(fingerprint).encode()}), cachePath)
+        print(f'Region polygon cache rebuilt at {cachePath}')
+
+    shapely.prepare(np.asarray(regionPolygons.geometry.values))
     return regionPolygons
 
 
-def assignPolygon(data, polygons):
+@profileStage
+def assignPolygon(data, polygons, maxDistance=None, keepFields=[]):
     """Given a dataset with  x/y coordinates in the BNG projection (EPSG:27700), classify each datapoint based on the regional polygon it is within.
-    For datapoints which don't sit within the bounds of any regional polygon (e.g. on the coast), find the closest polygon
+    For datapoints which don't sit within the bounds of any regional polygon (e.g. on the coast), find the closest polygon.
+    Points are matched in bulk using an STRtree spatial index and prepared polygon geometries, rather than testing every remaining point against every polygon in turn.
 
     Args:
         data (DataFrame): Base data including Id and x/y coordinates in EPSG:27700 projection
-        polygons (GeoDataFrame): including all regional polygons chosen for visualisation, with columns NUTS_ID, NUTS_NAME, CNTR_CODE and geometry (in EPSG:27700)
+        polygons (GeoDataFrame): including all regional polygons chosen for visualisation, with columns RegionID, RegionName, Country, CountryHL and geometry (in EPSG:27700)
+        maxDistance (float, optional): Maximum search distance (metres) for the nearest polygon fallback. Points further than this from every polygon are left as 'Unknown'. Defaults to None (no limit).
+        keepFields (list, optional): raw geo-columns (Town, County) to keep rather than remove, e.g. Town after enrichTowns. Defaults to [].
 
     Returns:
-        DataFrame: original dataframe with redundant geo-columns removed (Town, County) and updated region / Country information. Country represents lower level detail e.g. Wales, CountryHL repreents higher level e.g. UK
+        DataFrame: original dataframe with redundant geo-columns removed (Town, County) and updated region / Country information. Country represents lower level detail e.g. Wales, CountryHL repreents higher level e.g. UK.
+            RegionDistance holds the distance (metres) to the assigned polygon - 0 for points within a polygon
     """
-    
-    tempdata=gpd.GeoDataFrame(data[['Id']], geometry= gpd.points_from_xy(data.x, data.y))
-    tempdata['RegionID']='N/A'
-
-    generate_df=pd.DataFrame(columns=tempdata.columns)
-
-    # cycle through the region polygons, add those within polygon to output dataframe on each loop
-    for each in polygons.index:
-        out=tempdata.geometry.within(polygons.loc[each, 'geometry'])
-        tempdata.loc[out, 'RegionID']=polygons.loc[each, 'RegionID']
-        generate_df=pd.concat([generate_df, tempdata[out]], axis=0)
-        tempdata=tempdata.loc[~out].copy()
+    import geopandas as gpd
+    points=gpd.GeoSeries(gpd.points_from_xy(data.x, data.y))
+    polygons=polygons.reset_index(drop=True)
+
+    # bulk point-in-polygon query - each (prepared) polygon is tested against an STRtree of the points, returning (polygon position, point position) pairs for every match
+    # contains_properly is the inverse of within for points, but unlike within it can make use of the prepared polygon geometry
+    polyPos, pointPos=points.sindex.query(polygons.geometry, predicate='contains_properly')
+    # where polygons overlap, keep the first polygon in the region list (as per the original per-polygon loop)
+    regionPos=np.full(len(points), len(polygons))
+    np.minimum.at(regionPos, pointPos, polyPos)
+    distance=np.where(regionPos<len(polygons), 0.0, np.nan)
 
     # for those trees which don't fall within the exact polygon, get the nearest polygon (this is likely due to granularity of the data, mostly due to bein on the coast)
-    # we only use this approach for those which don't fall within as it means less computation
-    for each in polygons.index:
-        poly_id=polygons.loc[each, 'RegionID']
-        # column per polygon with distance to
-        tempdata[poly_id]=tempdata.geometry.distance(polygons.loc[each, 'geometry'])
-    # get polygon name for column with lowest distance
-    tempdata['RegionID']=tempdata[polygons.RegionID.unique()].idxmin(axis="columns")
-
-    # add these into the main output data 
-    generate_df=pd.concat([generate_df, tempdata[generate_df.columns]], axis=0)
-    generate_df=generate_df.merge(polygons[['RegionName', 'RegionID', 'CNTR_CODE', 'Country', 'CountryHL']], on='RegionID', how='left')
+    # we only use this approach for those which don't fall within as it means less computation. The polygon index only returns candidates within reach, 
+    # so exact distances are only computed for the closest polygons rather than for every point/polygon pair
+    # trees without coordinates can't be placed, so are left as 'Unknown'
+    unassigned=np.flatnonzero((regionPos==len(polygons))&data.x.notna().to_numpy()&data.y.notna().to_numpy())
+    if len(unassigned)>0:
+        (nearPointPos, nearPolyPos), nearDistance=polygons.sindex.nearest(points.iloc[unassigned], return_all=True, max_distance=maxDistance, return_distance=True)
+        # ties return every equidistant polygon - keep the first in the region list so results are deterministic
+        nearPos=np.full(len(unassigned), len(polygons))
+        np.minimum.at(nearPos, nearPointPos, nearPolyPos)
+        regionPos[unassigned]=nearPos
+        distance[unassigned[nearPointPos]]=nearDistance
 
     # original Country field to be replaced by polygon mapping and County/Town not required for analysis / not well populated
-    data=data.drop(columns=['Country', 'County', 'Town'])
-    # join new info into original dataset
-    data=data.merge(generate_df[['Id', 'RegionID', 'RegionName', 'Country', 'CountryHL']], on=['Id'], how='left')
+    data=data.drop(columns=[each for each in ['Country', 'County', 'Town'] if each not in keepFields]).reset_index(drop=True)
+    # join new info into original dataset (index-aligned by polygon position, so no merge on Id is needed)
+    found=regionPos<len(polygons)
+    for each in ['RegionID', 'RegionName', 'Country', 'CountryHL']:
+        data[each]=np.where(found, polygons[each].to_numpy(dtype=object)[np.minimum(regionPos, len(polygons)-1)], 'Unknown')
+    data['RegionDistance']=distance
     return data
 
 
-def archiveFiles(currentPath):
-    """Given a data folder, pick up all existing files and move into archive sub-folder
+def archiveFiles(currentPath, prefix=''):
+    """Given a data folder, pick up all existing files (and chunked parquet outputs, which are folders) and move into archive sub-folder
 
     Args:
         currentPath (string): path to data folder which contains files and a sub-folder called 'archive'
+        prefix (string, optional): only archive files whose names start with this e.g. 'ATI_Marker_table'. Defaults to '' (all files).
     """
     newpath=os.path.join(currentPath, 'archive/')
     for filename in os.listdir(currentPath):
-        if not os.path.isdir(os.path.join(currentPath, filename)):
+        if not filename.startswith(prefix):
+            continue
+        if not os.path.isdir(os.path.join(currentPath, filename)) or filename.endswith('.parquet'):
             os.rename(f"{currentPath}/{filename}", f"{newpath}{filename}")
             print(f'Archived file {filename}')
 
 
-def saveFile(data, filename, folder, fileFormat='csv'):
+@profileStage
+def saveFile(data, filename, folder, fileFormat='csv', timestamp=None, append=False, partitionCols=None):
     """Save the given dataset to the requested location, with a timestamp suffix on filename
 
     Args:
         data (DataFrame): target dataframe to be saved to given filetype
         filename (string): requested file name
         folder (string): output folder location
-        fileFormat (string) : output file type (csv/parquet). Defaults to csv
+        fileFormat (string) : output file type (csv/parquet/partitioned). partitioned writes a parquet dataset folder, split into sub-folders by partitionCols. Defaults to csv
+        timestamp (string, optional): timestamp suffix to use in place of the current time, so that repeated appends target the same file. Defaults to None.
+        append (bool, optional): add the data to the end of any existing output rather than overwriting. For parquet, each call writes a new part file within a folder named as the output file. 
+            Partitioned outputs always add new part files. Defaults to False.
+        partitionCols (list, optional): columns to partition by, for the partitioned file type. Defaults to None.
     """
     print(fileFormat)
-    now=dt.datetime.now().strftime("%d-%m-%Y_%H%M")
+    now=timestamp if timestamp is not None else dt.datetime.now().strftime("%d-%m-%Y_%H%M")
     if fileFormat=='csv':
         outputFileName=os.path.join(folder,f'{filename}_{now}.csv')
-        data.to_csv(outputFileName,index=False)
+        if append and os.path.exists(outputFileName):
+            data.to_csv(outputFileName,index=False, mode='a', header=False)
+        else:
+            data.to_csv(outputFileName,index=False)
         print(f'{filename} data saved with {len(data)} records saved to {outputFileName}')
     elif fileFormat=='parquet':
         outputFileName=os.path.join(folder,f'{filename}_{now}.parquet')
+        if append:
+            if not os.path.exists(outputFileName):
+                os.makedirs(outputFileName)
+            outputFileName=os.path.join(outputFileName, f'part-{len(os.listdir(outputFileName)):05d}.parquet')
         data.to_parquet(outputFileName,index=False)
         print(f'{filename} data saved with {len(data)} records saved to {outputFileName}')
+    elif fileFormat=='partitioned':
+        # pyarrow writes min/max statistics per row group, so readers can skip row groups as well as partitions
+        outputFileName=os.path.join(folder,f'{filename}_{now}.parquet')
+        data.to_parquet(outputFileName,index=False, partition_cols=partitionCols)
+        print(f'{filename} data saved with {len(data)} records saved to {outputFileName}')
 
 
 
@@ -307,7 +958,9 @@ def createDummyFiles(baseData, otherDatasets : list = [], indexField= '', idName
     # We want this to scale in case the data model expands to more than 2 tables, so instead of using a sample approach, we pre-generate random index to sample
     # Assuming OBJECTID index-ID column is available, which matches across available tables
     maxBaseID=baseData[idName].astype(int).max()
-    baseDummy=baseData.sample(nSamples).copy().reset_index(drop=True)
+    baseDummy=baseData.sample(nSamples).reset_index(drop=True)
+    # Arrow-backed text (see readCheckpoint) can't take the new numeric IDs, so sampled records are converted to plain objects
+    baseDummy=baseDummy.astype({each: object for each in baseDummy.select_dtypes('string').columns})
     if indexField!='' and indexField in baseDummy.columns:
         baseDummy[indexField]=baseDummy.index
 
@@ -321,8 +974,9 @@ def createDummyFiles(baseData, otherDatasets : list = [], indexField= '', idName
 
     dummyData=[]
     for ind in range(len(otherDatasets)):
-        copy=otherDatasets[ind].copy()
-        copy=copy[copy[idName].isin(list(id_dict.keys()))].copy()
+        # filter before copying, so only the sampled records are copied
+        copy=otherDatasets[ind][otherDatasets[ind][idName].isin(list(id_dict.keys()))]
+        copy=copy.astype({each: object for each in copy.select_dtypes('string').columns})
         #Assign random number to obfuscate ID
         copy[idName]=copy[idName].replace(id_dict)
         
@@ -346,15 +1000,175 @@ def getTown(row, geocoder):
     Returns:
         str: selected name of 'Town' or nearest estimation
     """
-    # Don't use this on an overall scale as would take a LONG time and the existing data doesn't allow for robust analysis. Just for exploring individual locations!
+    # Don't use this on an overall scale as would take a LONG time and the existing data doesn't allow for robust analysis. Just for exploring individual locations! (see enrichTowns instead)
     raw_address=geocoder.reverse(str(row.Latitude)+","+str(row.Longitude)).raw['address']
-    out='Unknown'
+    return townFromAddress(raw_address)
+
+
+def townFromAddress(address):
+    """Select the most appropriate level of detail equivalent to 'Town' from a reverse geocoded address, using the hierarchy:
+    village > hamlet > suburb > city_district > city
+
+    Args:
+        address (dict): address components, as per Nominatim
+
+    Returns:
+        str: selected name of 'Town', or 'Unknown'
+    """
     for each in ['village', 'hamlet', 'suburb', 'city_district', 'city']:
-        if each in raw_address:
-            out=raw_address[each]
-            break
-    return out
-    
+        if each in address:
+            return address[each]
+    return 'Unknown'
+
+
+def nominatimBackend(userAgent='ancient-trees', domain='nominatim.openstreetmap.org', scheme='https', timeout=10):
+    """Reverse geocoding backend using the Nominatim service (via GeoPy). Nominatim takes one location per request, so use with a batch size of 1 
+    and respect the usage policy of the service (max 1 request per second for the public instance)
+
+    Args:
+        userAgent (str, optional): user agent identifying this application to the service. Defaults to 'ancient-trees'.
+        domain (str, optional): Nominatim host, e.g. a local instance. Defaults to 'nominatim.openstreetmap.org'.
+        scheme (str, optional): 'https' or 'http'. Defaults to 'https'.
+        timeout (int, optional): request timeout in seconds. Defaults to 10.
+
+    Returns:
+        function: list of (latitude, longitude) -> list of address dicts
+    """
+    from geopy.geocoders import Nominatim
+    geocoder=Nominatim(user_agent=userAgent, domain=domain, scheme=scheme, timeout=timeout)
+    def reverse(batch):
+        results=[geocoder.reverse(f'{lat},{lon}', exactly_one=True) for lat, lon in batch]
+        return [each.raw.get('address', {}) if each is not None else {} for each in results]
+    return reverse
+
+
+def offlineBackend():
+    """Offline reverse geocoding backend using the reverse_geocoder package (nearest GeoNames populated place). Whole batches are looked up in one call.
+
+    Returns:
+        function: list of (latitude, longitude) -> list of address dicts
+    """
+    import reverse_geocoder
+    def reverse(batch):
+        return [{'city': each['name']} for each in reverse_geocoder.search(list(batch), verbose=False)]
+    return reverse
+
+
+geocodeBackends={'nominatim': nominatimBackend, 'offline': offlineBackend}
+
+
+async def reverseGeocode(coords, backend, batchSize=1, requestsPerSecond=1, concurrency=1, retries=3):
+    """Reverse geocode a list of locations in batches, with at most `concurrency` batches in flight and at most `requestsPerSecond` batches started per second.
+    Failed batches are retried with exponential backoff. Backends may be plain functions (run in a thread) or coroutine functions.
+
+    Args:
+        coords (list): (latitude, longitude) tuples
+        backend (function): list of (latitude, longitude) -> list of address dicts, e.g. nominatimBackend()
+        batchSize (int, optional): locations per backend call. Defaults to 1.
+        requestsPerSecond (float, optional): rate limit on backend calls, None for no limit. Defaults to 1.
+        concurrency (int, optional): maximum backend calls in progress at once. Defaults to 1.
+        retries (int, optional): retries per batch before giving up. Defaults to 3.
+
+    Returns:
+        list: address dict per location, or None where the lookup failed
+    """
+    semaphore=asyncio.Semaphore(concurrency)
+    limiter=asyncio.Lock()
+    interval=1/requestsPerSecond if requestsPerSecond else 0
+    nextSlot=[0.0]
+
+    async def throttle():
+        # calls are started no closer together than the interval
+        async with limiter:
+            loop=asyncio.get_running_loop()
+            wait=nextSlot[0]-loop.time()
+            if wait>0:
+                await asyncio.sleep(wait)
+            nextSlot[0]=loop.time()+interval
+
+    async def fetch(batch):
+        async with semaphore:
+            for attempt in range(retries+1):
+                await throttle()
+                try:
+                    if asyncio.iscoroutinefunction(backend):
+                        return await backend(batch)
+                    return await asyncio.to_thread(backend, batch)
+                except Exception as error:
+                    if attempt==retries:
+                        print(f'Reverse geocoding failed for {len(batch)} locations after {retries+1} attempts: {error}')
+                        return [None]*len(batch)
+                    await asyncio.sleep(2**attempt)
+
+    batches=[coords[i:i+batchSize] for i in range(0, len(coords), batchSize)]
+    results=await asyncio.gather(*[fetch(each) for each in batches])
+    return [address for batch in results for address in batch]
+
+
+@profileStage
+def enrichTowns(data, backend, cacheFile=None, precision=4, **geocodeOptions):
+    """Fill missing Town values by reverse geocoding the tree location - runs enrichTownsAsync to completion. 
+    Within a running event loop (e.g. a notebook) it is run in a separate thread with its own event loop - or await enrichTownsAsync directly instead.
+
+    Args:
+        data (DataFrame): raw ATI records including Town, Latitude and Longitude
+        backend (function): reverse geocoding backend, see reverseGeocode
+        cacheFile (str, optional): Location of the persisted location to Town cache (json). Defaults to None (no persistence).
+        precision (int, optional): decimal places of latitude/longitude used as the cache key. Defaults to 4.
+        **geocodeOptions: batchSize, requestsPerSecond, concurrency and retries, see reverseGeocode
+
+    Returns:
+        DataFrame: original dataframe with Town populated where possible
+    """
+    coroutine=enrichTownsAsync(data, backend, cacheFile, precision, **geocodeOptions)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def enrichTownsAsync(data, backend, cacheFile=None, precision=4, **geocodeOptions):
+    """Fill missing Town values by reverse geocoding the tree location. Only records without a Town (and with a location) are looked up, each distinct location once.
+    Locations are rounded to the given number of decimal places (4dp is roughly 10m) and the resulting Town names are kept in a json cache file, 
+    so a cached location is never sent to the backend again. Failed lookups are not cached, so are retried on the next run.
+
+    Args:
+        data (DataFrame): raw ATI records including Town, Latitude and Longitude
+        backend (function): reverse geocoding backend, see reverseGeocode
+        cacheFile (str, optional): Location of the persisted location to Town cache (json). Defaults to None (no persistence).
+        precision (int, optional): decimal places of latitude/longitude used as the cache key. Defaults to 4.
+        **geocodeOptions: batchSize, requestsPerSecond, concurrency and retries, see reverseGeocode
+
+    Returns:
+        DataFrame: original dataframe with Town populated where possible
+    """
+    cache={}
+    if cacheFile is not None and os.path.exists(cacheFile):
+        with open(cacheFile, 'r') as f:
+            cache=json.load(f)
+
+    latitude=pd.to_numeric(data.Latitude, errors='coerce').round(precision)
+    longitude=pd.to_numeric(data.Longitude, errors='coerce').round(precision)
+    missing=(data.Town.isnull() | data.Town.astype(str).str.strip().isin(['', 'Unknown', 'nan'])) & latitude.notnull() & longitude.notnull()
+    keys=pd.Series([f'{lat:.{precision}f},{lon:.{precision}f}' for lat, lon in zip(latitude[missing], longitude[missing])], index=data.index[missing], dtype=object)
+    newKeys=[each for each in keys.unique() if each not in cache]
+
+    if len(newKeys)>0:
+        addresses=await reverseGeocode([tuple(float(part) for part in each.split(',')) for each in newKeys], backend, **geocodeOptions)
+        found={key: townFromAddress(address) for key, address in zip(newKeys, addresses) if address is not None}
+        cache.update(found)
+        if cacheFile is not None and len(found)>0:
+            with open(cacheFile, 'w') as f:
+                json.dump(cache, f, indent=4)
+        print(f'{len(found)} of {len(newKeys)} new locations geocoded')
+
+    data=data.assign(Town=data.Town.mask(missing, keys.map(cache)))
+    print(f'Town enrichment complete ({missing.sum()} records without Town)')
+    return data
+
+
 def getLocation(row, geocoder, uk_countries):
     """ LEGACY - NOT IN USE 
     Row-level function for use in DataFrame lambda. Clean existing County/Country fields where wrong level of detail found, and fetch geospatial attributes using reverse geocoding where fields are not populated.
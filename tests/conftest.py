@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the pipeline modules live in src/ and import each other by name (as when run from the src folder)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
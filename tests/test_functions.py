@@ -0,0 +1,106 @@
+import io
+import itertools
+
+import pandas as pd
+import pytest
+
+import functions
+
+
+def livingStatusFlagsRowwise(row):
+    """Reference - the original row-wise livingStatusFlags (applied with DataFrame.apply, axis=1), kept to check the vectorised version against"""
+    testcase=row.LivingStatus.lower()
+    if 'alive' in testcase:
+        row['LivingGroup']='Alive'
+    elif 'dead' in testcase:
+        row['LivingGroup']='Dead'
+    else:
+        row['LivingGroup']='Unknown'
+
+    if 'chalara fraxinea' in testcase:
+        if 'confirmed' in testcase:
+            row['AshDieback']='Confirmed'
+        else:
+            row['AshDieback']='Suspected'
+    elif 'Ash' in row.SpeciesGroup:
+        row['AshDieback']='Unknown'
+    else:
+        row['AshDieback']='N/A'
+    return row
+
+
+livingStatuses=['Alive', 'Dead', 'Unknown', 'ALIVE - standing', 'dead (fallen)', 'Other - Chalara fraxinea (Ash dieback) suspected',
+                'Other - Chalara fraxinea (Ash dieback) confirmed', 'Other - CHALARA FRAXINEA CONFIRMED', 'Other - Acute oak decline (AOD) suspected',
+                'Other - alive but chalara fraxinea suspected', 'Other - dead, chalara fraxinea confirmed', 'Other - deadwood only', '']
+speciesGroups=['Ash', 'Oak', 'Mountain ash', 'ash', 'Unknown', 'Ashridge oak', '']
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_livingStatusFlags_matches_rowwise(categorical):
+    cases=pd.DataFrame(list(itertools.product(livingStatuses, speciesGroups)), columns=['LivingStatus', 'SpeciesGroup'])
+    expected=cases.apply(livingStatusFlagsRowwise, axis=1)
+
+    data=cases.copy()
+    if categorical:
+        # the pipeline stores SpeciesGroup as a categorical (see assignSpeciesGroups)
+        data['SpeciesGroup']=data.SpeciesGroup.astype('category')
+    functions.livingStatusFlags(data)
+    pd.testing.assert_frame_equal(data[['LivingGroup', 'AshDieback']].astype(object), expected[['LivingGroup', 'AshDieback']].astype(object))
+
+
+def test_hashRows_chunks_match_whole_file():
+    # Girth would be inferred as an integer column in the first chunk but float in the second (missing value), and Town as float in the first chunk (all missing) -
+    # so the download is read with fixed types, as per sourceTypes in the config
+    text='Id,Girth,Town\n1,5,\n2,6,\n3,,Leeds\n4,7,York\n'
+    sourceTypes={'Id': 'str', 'Girth': 'float64', 'Town': 'str'}
+    whole=functions.hashRows(pd.read_csv(io.StringIO(text), dtype=sourceTypes))
+    chunks=pd.concat(functions.hashRows(chunk) for chunk in pd.read_csv(io.StringIO(text), dtype=sourceTypes, chunksize=2))
+    pd.testing.assert_frame_equal(whole, chunks.reset_index(drop=True))
+    changed, deleted=functions.compareManifests(whole, chunks)
+    assert changed==set() and deleted==set()
+
+
+def test_fingerprintSettings_changes_with_settings_and_polygons():
+    geopandas=pytest.importorskip('geopandas')
+    shapely=pytest.importorskip('shapely')
+    polygons=geopandas.GeoDataFrame({'RegionID': ['A']}, geometry=[shapely.box(0, 0, 10, 10)], crs='EPSG:27700')
+    moved=geopandas.GeoDataFrame({'RegionID': ['A']}, geometry=[shapely.box(0, 0, 10, 20)], crs='EPSG:27700')
+    fingerprint=functions.fingerprintSettings({'regionMaxDistance': None}, polygons)
+    assert fingerprint==functions.fingerprintSettings({'regionMaxDistance': None}, polygons.copy())
+    assert fingerprint!=functions.fingerprintSettings({'regionMaxDistance': 100}, polygons)
+    assert fingerprint!=functions.fingerprintSettings({'regionMaxDistance': None}, moved)
+
+
+def test_profileStage_records_start_and_stage_peak():
+    import datetime as dt
+    import time
+    import numpy as np
+
+    @functions.profileStage
+    def allocate(n):
+        data=np.ones(n)
+        time.sleep(1.1)
+        return data.sum()
+
+    functions.stageReport.clear()
+    before=dt.datetime.now().replace(microsecond=0)
+    allocate(20_000_000)
+    entry=functions.stageReport.pop()
+    # start is recorded (to the second) before the call, not after it
+    assert dt.datetime.fromisoformat(entry['start'])-before<dt.timedelta(seconds=1)
+    # 160MB held during the call, released before it returns
+    assert entry['stagePeakRSS']-entry['rssStart']>100_000_000
+    assert entry['rssEnd']-entry['rssStart']<100_000_000
+
+
+def test_readCheckpoint_keeps_categoricals_across_parts(tmp_path):
+    pytest.importorskip('pyarrow')
+    # one part per chunk - with different categories, and a column which is all missing in the first chunk
+    first=pd.DataFrame({'Id': ['1', '2'], 'RegionID': pd.Categorical(['UKC1', 'UKC2']), 'Town': pd.Series([None, None], dtype=object)})
+    second=pd.DataFrame({'Id': ['3'], 'RegionID': pd.Categorical(['UKD1']), 'Town': ['Leeds']})
+    functions.writeCheckpoint(first, 'ATI_Base_table', str(tmp_path))
+    functions.writeCheckpoint(second, 'ATI_Base_table', str(tmp_path), append=True)
+    result=functions.readCheckpoint('ATI_Base_table', str(tmp_path))
+    assert isinstance(result.RegionID.dtype, pd.CategoricalDtype)
+    assert result.RegionID.tolist()==['UKC1', 'UKC2', 'UKD1']
+    assert result.Town.isnull().tolist()==[True, True, False]
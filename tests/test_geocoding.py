@@ -0,0 +1,112 @@
+import asyncio
+import json
+import threading
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions
+
+# (latitude, longitude) which the stand-in service always fails on
+failingLocation=(51.3, -1.3)
+
+
+class ReverseHandler(BaseHTTPRequestHandler):
+    """Stand-in for the Nominatim /reverse endpoint - records every location requested, and names each location's village after its coordinates"""
+    def do_GET(self):
+        query=urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        location=(float(query['lat'][0]), float(query['lon'][0]))
+        self.server.requests.append(location)
+        if location==failingLocation:
+            self.send_error(500)
+            return
+        body=json.dumps({'place_id': 1, 'lat': query['lat'][0], 'lon': query['lon'][0], 'display_name': 'Test',
+                         'address': {'village': f'Village {location[0]:.4f},{location[1]:.4f}'}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server=ThreadingHTTPServer(('localhost', 0), ReverseHandler)
+    server.requests=[]
+    thread=threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def httpBackend(host):
+    """Minimal backend calling the stand-in service directly, so the test doesn't depend on geopy"""
+    def reverse(batch):
+        addresses=[]
+        for lat, lon in batch:
+            with urllib.request.urlopen(f'http://{host}/reverse?lat={lat}&lon={lon}&format=json', timeout=5) as response:
+                addresses.append(json.load(response).get('address', {}))
+        return addresses
+    return reverse
+
+
+def makeTrees():
+    return pd.DataFrame({'Id': [1, 2, 3, 4, 5],
+                         'Town': ['Existing', np.nan, 'Unknown', np.nan, np.nan],
+                         # cached, new, failing, and a location rounding to the same key as the new one
+                         'Latitude': [51.0, 51.1, 51.2, 51.3, 51.20001],
+                         'Longitude': [-1.0, -1.1, -1.2, -1.3, -1.20001]})
+
+
+def checkEnrichment(server, backend, tmp_path):
+    cacheFile=tmp_path/'town_geocode_cache.json'
+    cacheFile.write_text(json.dumps({'51.1000,-1.1000': 'Cached Town'}))
+    options={'batchSize': 1, 'requestsPerSecond': None, 'concurrency': 2, 'retries': 1}
+
+    result=functions.enrichTowns(makeTrees(), backend, str(cacheFile), 4, **options)
+    # existing Town untouched (and not looked up), cached location never sent to the backend, each new location looked up once
+    assert result.Town.iloc[0]=='Existing'
+    assert result.Town.iloc[1]=='Cached Town'
+    assert result.Town.iloc[2]=='Village 51.2000,-1.2000' and result.Town.iloc[4]=='Village 51.2000,-1.2000'
+    assert (51.0, -1.0) not in server.requests and (51.1, -1.1) not in server.requests
+    assert server.requests.count((51.2, -1.2))==1
+    # failed location retried, then left empty and uncached
+    assert server.requests.count(failingLocation)==2
+    assert pd.isnull(result.Town.iloc[3])
+    cache=json.loads(cacheFile.read_text())
+    assert '51.3000,-1.3000' not in cache and cache['51.2000,-1.2000']=='Village 51.2000,-1.2000'
+
+    # next run - only the failed location is sent again
+    server.requests.clear()
+    result=functions.enrichTowns(makeTrees(), backend, str(cacheFile), 4, **options)
+    assert server.requests==[failingLocation]*2
+    assert result.Town.iloc[2]=='Village 51.2000,-1.2000'
+
+
+def test_enrichTowns_local_service(server, tmp_path):
+    checkEnrichment(server, httpBackend(f'localhost:{server.server_port}'), tmp_path)
+
+
+def test_enrichTowns_nominatim_backend(server, tmp_path):
+    pytest.importorskip('geopy')
+    checkEnrichment(server, functions.nominatimBackend(domain=f'localhost:{server.server_port}', scheme='http'), tmp_path)
+
+
+def test_enrichTowns_within_running_event_loop(server):
+    # e.g. called from a notebook - the blocking call falls back to a separate thread, and the coroutine can be awaited directly
+    backend=httpBackend(f'localhost:{server.server_port}')
+    options={'requestsPerSecond': None, 'retries': 0}
+
+    async def run():
+        return functions.enrichTowns(makeTrees(), backend, **options), await functions.enrichTownsAsync(makeTrees(), backend, **options)
+
+    for result in asyncio.run(run()):
+        assert result.Town.iloc[2]=='Village 51.2000,-1.2000'
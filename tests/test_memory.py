@@ -0,0 +1,51 @@
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions
+
+# memory caps on the hot-path stages, as a multiple of the in-memory size of their input - measured with tracemalloc, which covers python, numpy and pandas allocations
+# (GEOS geometries and arrow buffers are allocated outside of it). Measured at ~3x for createMarkerTable and ~1.1x for assignPolygon, including their outputs
+nRecords=50_000
+markerDict={'Protection': ',', 'Epiphyte': ',', 'Fungus': ',', 'Condition': ','}
+markerReplacements={"''": "'", 'â€™': "'", 'â€“': '-'}
+markerValues=np.array(['Tree Preservation Order', 'Lichen', 'Moss', 'Ivy', 'Hollowing', 'Bark loss', "Owner''s land", 'Dryadâ€™s saddle', 'Woodland â€“ broadleaf'], dtype=object)
+
+
+def peakAllocation(func, *args, **kwargs):
+    """Peak memory allocated (bytes) while running func, once warmed up (so lazy imports and caches aren't counted)"""
+    func(*args, **kwargs)
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def makeMarkerData(n, rng):
+    data={'Id': np.arange(n)}
+    for each in markerDict:
+        data[each]=[', '.join(rng.choice(markerValues, k)) if k>0 else 'Unknown' for k in rng.integers(0, 4, n)]
+    return pd.DataFrame(data)
+
+
+def test_createMarkerTable_memory():
+    data=makeMarkerData(nRecords, np.random.default_rng(0))
+    inputSize=data.memory_usage(deep=True).sum()
+    assert peakAllocation(functions.createMarkerTable, data, markerDict, markerReplacements)<=4*inputSize
+
+
+def test_assignPolygon_memory():
+    geopandas=pytest.importorskip('geopandas')
+    shapely=pytest.importorskip('shapely')
+    rng=np.random.default_rng(0)
+    # 4x4 grid of 10km regions with gaps between them, and points spread a little beyond the grid - so both the within and nearest polygon paths are used
+    polygons=geopandas.GeoDataFrame({'RegionID': [f'R{i}' for i in range(16)], 'RegionName': [f'Region {i}' for i in range(16)], 'Country': 'England', 'CountryHL': 'UK'},
+                                    geometry=[shapely.box(i%4*10000, i//4*10000, i%4*10000+9900, i//4*10000+9900) for i in range(16)], crs='EPSG:27700')
+    data=pd.DataFrame({'Id': np.arange(nRecords), 'x': rng.uniform(-5000, 45000, nRecords), 'y': rng.uniform(-5000, 45000, nRecords),
+                       'Country': 'England', 'County': 'Unknown', 'Town': 'Unknown'})
+    inputSize=data.memory_usage(deep=True).sum()
+    assert peakAllocation(functions.assignPolygon, data, polygons)<=2*inputSize
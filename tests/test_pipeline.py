@@ -0,0 +1,89 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pytest
+
+geopandas=pytest.importorskip('geopandas')
+import ancientTreeDataPrep as prep
+import benchmark
+
+repoDir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def polygons():
+    # the combined region shapefile from the repo, rather than rebuilding it from the source shape files (with the simplified copy as per the cache, see fetchPolygons)
+    regionPolygons=geopandas.read_file(os.path.join(repoDir, 'data', 'input', 'VisRegions', 'region_polygons.shp'))
+    regionPolygons['SimplifiedGeometry']=regionPolygons.geometry.simplify(100)
+    return regionPolygons
+
+
+@pytest.fixture
+def download(polygons, tmp_path, monkeypatch):
+    """Write a synthetic download (with a copy of an early record appended, so the two copies fall in different partitions / chunks) and point the pipeline at it"""
+    raw=benchmark.makeSyntheticATI(400, polygons, seed=0)
+    raw=pd.concat([raw, raw.iloc[[7]]], ignore_index=True)
+    raw.to_csv(tmp_path/'download.csv', index=False)
+    monkeypatch.setattr(prep, 'sourcefile', str(tmp_path/'download.csv'))
+    monkeypatch.setitem(prep.configs, 'speciesLookupFile', str(tmp_path/'species_group_lookup.json'))
+    return raw
+
+
+def test_pool_matches_serial_with_repeated_id(polygons, download, monkeypatch):
+    monkeypatch.setitem(prep.configs, 'workers', 2)
+    lookupFile=os.path.join(prep.datafolder, prep.configs['speciesLookupFile'])
+    serialBase, serialMarkers=prep.runBatch(prep.readSource(), polygons)
+    with open(lookupFile) as f:
+        serialLookup=f.read()
+    # the species spellings grouped by the workers are written to the lookup file by the parent process, as per a serial run
+    os.remove(lookupFile)
+    with ProcessPoolExecutor(max_workers=2, initializer=prep.initWorker, initargs=(polygons, None)) as pool:
+        poolBase, poolMarkers=prep.runBatch(prep.readSource(), polygons, pool)
+    pd.testing.assert_frame_equal(serialBase, poolBase)
+    pd.testing.assert_frame_equal(serialMarkers, poolMarkers)
+    with open(lookupFile) as f:
+        assert f.read()==serialLookup
+
+
+def runPrep(folder, monkeypatch, polygons, **settings):
+    """Run the prep stage into the given folder, with the given config overrides"""
+    for each in ['actual', 'dummy']:
+        os.makedirs(os.path.join(folder, each, 'archive'), exist_ok=True)
+    monkeypatch.setattr(prep, 'outputfolder', os.path.join(folder, 'actual'))
+    monkeypatch.setattr(prep, 'outputfolderDummy', os.path.join(folder, 'dummy'))
+    monkeypatch.setattr(prep, 'loadPolygons', lambda: polygons)
+    for each in settings:
+        monkeypatch.setitem(prep.configs, each, settings[each])
+    prep.runPrep()
+    return {each: prep.functions.loadFile(prep.functions.findLatestFile(prep.outputfolder, each, fileFormat), fileFormat) 
+            for each, fileFormat in [('ATI_Base_table', settings['outputFormat']), ('ATI_Marker_table', settings['outputFormat']), 
+                                     ('ATI_Tree_counts', prep.aggregateFormat), ('ATI_Marker_counts', prep.aggregateFormat), ('ATI_manifest', 'csv')]}
+
+
+@pytest.mark.parametrize('outputFormat', ['csv', 'parquet'])
+def test_chunked_matches_whole_file(polygons, download, tmp_path, monkeypatch, outputFormat):
+    # MeasuredHeight is a whole number throughout the first chunks, but fractional or missing in the later ones - so its inferred type would differ between chunks
+    download['MeasuredHeight']=download.MeasuredHeight.round().astype('Int64').astype(object)
+    download.loc[300:350, 'MeasuredHeight']=None
+    download.loc[351:360, 'MeasuredHeight']=1.3
+    download.to_csv(prep.sourcefile, index=False)
+
+    whole=runPrep(tmp_path/'whole', monkeypatch, polygons, outputFormat=outputFormat, chunkSize=None)
+    chunked=runPrep(tmp_path/'chunked', monkeypatch, polygons, outputFormat=outputFormat, chunkSize=100)
+    # categories are listed in order of appearance across the chunks, rather than sorted
+    pd.testing.assert_frame_equal(whole['ATI_Base_table'], chunked['ATI_Base_table'], check_categorical=False)
+    # markers are ordered within each chunk rather than across the whole download
+    sortMarkers=lambda markers: markers.sort_values(['MarkerType', 'Id', 'MarkerValue'], kind='stable').reset_index(drop=True)
+    pd.testing.assert_frame_equal(sortMarkers(whole['ATI_Marker_table']), sortMarkers(chunked['ATI_Marker_table']), check_categorical=False)
+    for each in ['ATI_Tree_counts', 'ATI_Marker_counts', 'ATI_manifest']:
+        pd.testing.assert_frame_equal(whole[each], chunked[each])
+
+
+def test_incremental_with_repeated_id(polygons, download, tmp_path, monkeypatch, capsys):
+    first=runPrep(tmp_path, monkeypatch, polygons, outputFormat='csv', chunkSize=None, incremental=True)
+    # records can't be matched up by Id, so the next run is a full refresh
+    second=runPrep(tmp_path, monkeypatch, polygons, outputFormat='csv', chunkSize=None, incremental=True)
+    assert 'Repeated Ids in the download or the previous run - running full refresh' in capsys.readouterr().out
+    for each in first:
+        pd.testing.assert_frame_equal(first[each], second[each])